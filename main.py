@@ -10,15 +10,19 @@ from dotenv import load_dotenv
 load_dotenv(".env")
 
 
+import argparse
 import glob
 import os
-import time
+import sys
 from collections import defaultdict
 
-from tqdm.auto import tqdm
-
-from src.code_generator import CodeGenerator
 from src.dataset import Dataset
+from src.dataset.ds1000 import get_execution_cache
+from src.dataset.executor import current_executor, resource_usage
+from src.dataset.preflight import preflight_stats
+from src.llm import get_response_cache
+from src.scheduler import ProblemScheduler
+from src.work_queue import QueueWorker, SQLiteQueue, coordinate, merge
 
 LIBRARIES = [
     "Pandas",
@@ -31,90 +35,12 @@ LIBRARIES = [
 ]
 
 MAX_SELF_CORRECTION_ATTEMPTS = 5
+CORRECTION_STRATEGY = "zero-shot"  # "cot" reuses the initial CoT suggestions
+MAX_CONCURRENT_PROBLEMS = int(os.getenv("MAX_CONCURRENT_PROBLEMS", 8))
+MAX_CONCURRENT_TESTS = int(os.getenv("MAX_CONCURRENT_TESTS", 4))
 
-if __name__ == "__main__":
-    # Prepare datasets
-    stack_overflow_dataset = Dataset(
-        dataset="stack_overflow", kwargs={"download": False}
-    ).dataset
-
-    problem_dataset = Dataset(dataset="ds-1000", kwargs=None).dataset
-
-    # Create directories
-    strategy = "v4"  # improved prompt following `SELFEVOLVE` paper
-    if not os.path.exists(f"generated_code/initial/{strategy}"):
-        os.makedirs(f"generated_code/initial/{strategy}")
-    if not os.path.exists(f"generated_code/correcting/{strategy}"):
-        os.makedirs(f"generated_code/correcting/{strategy}")
-
-    for lib in LIBRARIES:
-        for i in tqdm(
-            range(len(problem_dataset[lib])), desc=f"Solving problem for {lib}"
-        ):
-            # Skip solved problems
-            if os.path.exists(
-                f"generated_code/correcting/{strategy}/{lib}_{str(i).zfill(3)}.txt"
-            ):
-                continue
-
-            challenge = problem_dataset[lib][i]
-            problem = challenge["prompt"]
-            code_context = challenge["code_context"]
-
-            initial_generator = CodeGenerator(model="gpt35-turbo", strategy="cot")
-
-            generated_code = initial_generator.generate(
-                problem=problem,
-                code_context=code_context,
-                stack_overflow=stack_overflow_dataset,
-                feedback=None,
-            )
-            dataset_dir = os.getcwd()
-            with open(
-                f"generated_code/initial/{strategy}/{lib}_{str(i).zfill(3)}.py", "w"
-            ) as f:
-                f.write(generated_code)
-
-            is_correct = challenge.test(generated_code)
-
-            # Handle self-correction
-            attempt = 0
-            while (attempt < MAX_SELF_CORRECTION_ATTEMPTS) and (is_correct != True):
-                if isinstance(is_correct, tuple):
-                    correcting_generator = CodeGenerator(
-                        model="gpt35-turbo", strategy="zero-shot"
-                    )
-
-                    generated_code = correcting_generator.generate(
-                        problem=problem,
-                        code_context=code_context,
-                        stack_overflow=stack_overflow_dataset,
-                        feedback=is_correct,
-                    )
-                    os.chdir(dataset_dir)
-                    with open(
-                        f"generated_code/correcting/{strategy}/{lib}_{str(i).zfill(3)}.py",
-                        "w",
-                    ) as f:
-                        f.write(generated_code)
-
-                    is_correct = challenge.test(generated_code)
-
-                    attempt += 1
-                elif isinstance(is_correct, bool):
-                    break
-
-            os.chdir(dataset_dir)
-            with open(
-                f"generated_code/correcting/{strategy}/{lib}_{str(i).zfill(3)}.txt", "w"
-            ) as f:
-                if isinstance(is_correct, bool) and (is_correct == True):
-                    f.write("Correct")
-                else:
-                    f.write("Incorrect")
-
-            time.sleep(5)
 
+def print_accuracy(strategy: str) -> None:
     results = defaultdict(lambda: [0, 0])
     for file in glob.glob(f"generated_code/correcting/{strategy}/*.txt"):
         lib = os.path.basename(file).split("_")[0]
@@ -128,3 +54,84 @@ if __name__ == "__main__":
     for lib, (correct, total) in results.items():
         accuracy = correct / total if total else 0
         print(f"{lib}: {accuracy * 100:.2f}%")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Solve DS-1000 with self-debugging")
+    parser.add_argument(
+        "--mode",
+        type=str,
+        default="run",
+        choices=["run", "coordinate", "work", "merge"],
+        help="run solves every problem in this process; coordinate enqueues them "
+        "into the work queue, work solves queued jobs until the queue is drained "
+        "and merge writes the results of every worker",
+    )
+    parser.add_argument(
+        "--queue",
+        type=str,
+        default="generated_code/queue.sqlite",
+        help="SQLite file of the work queue, shared by every worker",
+    )
+    parser.add_argument("--worker_id", type=str, default=None)
+    parser.add_argument(
+        "--lease",
+        type=float,
+        default=300,
+        help="seconds before a job of an unresponsive worker is leased again",
+    )
+    args = parser.parse_args()
+
+    # Prepare datasets
+    stack_overflow_dataset = Dataset(
+        dataset="stack_overflow", kwargs={"download": False}
+    ).dataset
+
+    problem_dataset = Dataset(dataset="ds-1000", kwargs=None).dataset
+
+    # Solve problems concurrently
+    strategy = "v4"  # improved prompt following `SELFEVOLVE` paper
+    scheduler = ProblemScheduler(
+        problem_dataset=problem_dataset,
+        stack_overflow=stack_overflow_dataset,
+        strategy=strategy,
+        output_dir="generated_code",
+        max_concurrency=MAX_CONCURRENT_PROBLEMS,
+        max_attempts=MAX_SELF_CORRECTION_ATTEMPTS,
+        correction_strategy=CORRECTION_STRATEGY,
+        test_workers=MAX_CONCURRENT_TESTS,
+    )
+    if args.mode == "run":
+        scheduler.precompute_cot(LIBRARIES)
+        scheduler.calibrate_timeouts(LIBRARIES)
+        scheduler.run(LIBRARIES)
+    elif args.mode == "coordinate":
+        coordinate(scheduler, SQLiteQueue(args.queue), LIBRARIES)
+        sys.exit(0)
+    elif args.mode == "merge":
+        merge(SQLiteQueue(args.queue), "generated_code", strategy)
+        print_accuracy(strategy)
+        sys.exit(0)
+    else:
+        QueueWorker(
+            scheduler,
+            SQLiteQueue(args.queue),
+            worker_id=args.worker_id,
+            concurrency=MAX_CONCURRENT_PROBLEMS,
+            lease_seconds=args.lease,
+        ).run()
+
+    print_accuracy(strategy)
+    print(f"LLM cache: {get_response_cache().summary()}")
+    print(f"Execution cache: {get_execution_cache().summary()}")
+    print(f"Test executions: {resource_usage.summary()}")
+    # Only report templates when tests were executed in this process
+    executor = current_executor()
+    profile_report = executor.profile_report() if executor is not None else {}
+    for lib, profile in profile_report.items():
+        print(
+            f"{lib} template: imports {profile['import_time']:.2f}s, "
+            f"{profile['import_rss'] / (1 << 20):.1f} MiB, "
+            f"saved {profile['saved_time']:.2f}s over {profile['executions']} executions"
+        )
+    print(f"Pre-flight checks: {preflight_stats.summary()}")
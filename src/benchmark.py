@@ -0,0 +1,159 @@
+import argparse
+import csv
+import json
+import os
+import random
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+from tqdm.auto import tqdm
+
+from src.dataset.ds1000 import DS1000Dataset
+from src.dataset.executor import get_executor
+from src.dataset.timeouts import percentile
+from src.utils import PROJECT_ROOT
+
+LIBRARIES = [
+    "Pandas",
+    "Numpy",
+    "Tensorflow",
+    "Scipy",
+    "Sklearn",
+    "Pytorch",
+    "Matplotlib",
+]
+
+PHASES = [
+    "sandbox",
+    "interpreter",
+    "imports",
+    "user_code",
+    "result_dump",
+    "result_load",
+    "answer_load",
+    "comparison",
+    "total",
+]
+
+
+def _summarize(durations: Dict[str, List[float]]) -> Dict[str, dict]:
+    return {
+        phase: {
+            "n": len(durations[phase]),
+            "p50": percentile(durations[phase], 50),
+            "p95": percentile(durations[phase], 95),
+        }
+        for phase in PHASES
+        if durations.get(phase)
+    }
+
+
+def benchmark(
+    source_dir: str,
+    mode: str,
+    libraries: List[str],
+    sample: int,
+    repeat: int,
+    seed: int,
+) -> dict:
+    """
+    Run the reference solutions of `sample` problems per library through
+    `DS1000Problem.test`, without the execution cache and the runtime history,
+    and time each phase.
+    """
+    dataset = DS1000Dataset(source_dir, libs=libraries, mode=mode)
+    rng = random.Random(seed)
+    durations = {lib: defaultdict(list) for lib in libraries}
+    failed = []
+    for lib in libraries:
+        problems = list(dataset[lib])
+        problems = rng.sample(problems, min(sample, len(problems)))
+        for problem in tqdm(problems, desc=f"Benchmarking {lib}"):
+            for _ in range(repeat):
+                start = time.perf_counter()
+                is_correct = problem.test(
+                    problem["reference_code"],
+                    official_time_limit=True,
+                    use_cache=False,
+                    timings=durations[lib],
+                )
+                durations[lib]["total"].append(time.perf_counter() - start)
+                if is_correct is not True:
+                    failed.append(f"{lib}/{problem.problem_path.name}")
+            problem.release_answers()
+
+    overall = defaultdict(list)
+    for lib_durations in durations.values():
+        for phase, values in lib_durations.items():
+            overall[phase].extend(values)
+    return {
+        "config": {
+            "mode": mode,
+            "sample": sample,
+            "repeat": repeat,
+            "seed": seed,
+            "executor": type(get_executor()).__name__,
+            "sandbox": os.getenv("DS1000_SANDBOX", "link"),
+        },
+        "notes": {
+            "result_dump": "pickling the result in memory, it is not written to disk",
+            "result_load": "unpickling the result from memory, it is not read from disk",
+        },
+        "failed": failed,
+        "templates": get_executor().profile_report(),
+        "libraries": {lib: _summarize(durations[lib]) for lib in libraries},
+        "overall": _summarize(overall),
+    }
+
+
+def write_report(report: dict, path: str) -> None:
+    if path.endswith(".csv"):
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["library", "phase", "n", "p50", "p95"])
+            for lib, phases in list(report["libraries"].items()) + [
+                ("all", report["overall"])
+            ]:
+                for phase, stats in phases.items():
+                    writer.writerow(
+                        [lib, phase, stats["n"], stats["p50"], stats["p95"]]
+                    )
+    else:
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the overhead of DS1000Problem.test per phase"
+    )
+    parser.add_argument("--source_dir", type=str, default="ds1000_data")
+    parser.add_argument("--mode", type=str, default="Completion")
+    parser.add_argument("--libs", type=str, nargs="+", default=LIBRARIES)
+    parser.add_argument("--sample", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="benchmark_report.json",
+        help="JSON report, or CSV when the path ends with .csv",
+    )
+    args = parser.parse_args()
+
+    report = benchmark(
+        args.source_dir, args.mode, args.libs, args.sample, args.repeat, args.seed
+    )
+    # `src.dataset` moves into its own directory, so the output is relative
+    # to the project root
+    output = os.path.join(PROJECT_ROOT, args.output)
+    write_report(report, output)
+    for phase, stats in report["overall"].items():
+        note = report["notes"].get(phase)
+        print(
+            f"{phase}: p50 {stats['p50'] * 1000:.2f} ms, "
+            f"p95 {stats['p95'] * 1000:.2f} ms ({stats['n']} samples)"
+            + (f", {note}" if note else "")
+        )
+    print(f"Report written to {output}")
@@ -1,12 +1,95 @@
 import re
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
 
 import openai
 from langchain_core.prompts import ChatPromptTemplate
+from tqdm.auto import tqdm
 
 from src.dataset.stack_overflow import StackOverflowDataset
 from src.llm import LLM
-from src.utils import syntax_check
+from src.utils import hashes, syntax_check
+
+
+class CoTStage:
+    """
+    Generates the Chain-of-Thought suggestions of a problem from its most
+    relevant Stack Overflow post.
+
+    The suggestions only depend on the problem and the post: the prompt is
+    deterministic, so the LLM response cache shares them between every run
+    and self-correction attempt.
+    """
+
+    def __init__(self, model: str):
+        self.model = model
+        self.llm = LLM(
+            model=model, config={"temperature": 0, "max_retries": 10, "verbose": True}
+        )
+        self._posts: Dict[str, list] = {}
+
+    def retrieve(self, problem: str, stack_overflow: StackOverflowDataset) -> list:
+        key = hashes(problem)
+        if key not in self._posts:
+            self._posts[key] = stack_overflow.retrieve(query=problem, k=1)
+        return self._posts[key]
+
+    def suggest(self, problem: str, stack_overflow: StackOverflowDataset) -> str:
+        # Retrieve relevant Stack Overflow post
+        post = self.retrieve(problem=problem, stack_overflow=stack_overflow)
+
+        # CoT generation
+        system = "You are a helpful Chain-of-Thought generator that can understand the reasoning behind programming problems and provide step-by-step guidance to solve them."
+        human = """
+            Given the problem description with the code, and a Stack Overflow post, you need to learn from the comments to generate step-by-step suggestions that help another agent to solve the problem.
+
+            The given problem is: {problem_description}.
+
+            The Stack Overflow post with supportive comments is: {post}.
+
+            Please generate a series of suggestions that help another agent to solve the problem step-by-step.
+            Here are some suggestions:
+            - Suggestion 1: [...]
+            - Suggestion 2: [...]
+            - Suggestion 3: [...]
+            - Final suggestion: [...]
+            """
+        prompt = ChatPromptTemplate.from_messages(
+            [("system", system), ("human", human)]
+        )
+
+        # Invoke the LLM, replayed from the response cache when possible
+        return self.llm.invoke(
+            prompt.invoke(
+                {
+                    "problem_description": problem,
+                    "post": post,
+                }
+            ),
+        ).content
+
+    def precompute(
+        self,
+        problems: List[str],
+        stack_overflow: StackOverflowDataset,
+        max_workers: int = 8,
+    ) -> None:
+        """
+        Generate the suggestions of many problems ahead of code generation.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            list(
+                tqdm(
+                    pool.map(
+                        lambda problem: self.suggest(
+                            problem=problem, stack_overflow=stack_overflow
+                        ),
+                        problems,
+                    ),
+                    total=len(problems),
+                    desc="Generating CoT suggestions",
+                )
+            )
 
 
 class CodeGenerator:
@@ -14,7 +97,50 @@ class CodeGenerator:
         self.strategy = strategy
         self.llm = LLM(
             model=model, config={"temperature": 0, "max_retries": 10, "verbose": True}
-        ).llm
+        )
+        self.cot = CoTStage(model=model) if strategy == "cot" else None
+
+    @staticmethod
+    def _feedback_prompt(feedback: Optional[tuple]) -> str:
+        if feedback:
+            if feedback[1].startswith("Timeout:"):
+                return """
+                    In the previous attempt, you generated the following code inside the block ###BEGIN SOLUTION and ###END SOLUTION:
+                    ```
+                    {generated_code}
+                    ```
+                    However, the code was stopped because it ran out of time:
+                    ```
+                    {feedback}
+                    ```
+                    Please check the code for infinite loops and make it more efficient, e.g. by using vectorized operations instead of Python loops.
+                    """
+            elif "traceback" in feedback[1].lower():
+                return """
+                    In the previous attempt, you generated the following code inside the block ###BEGIN SOLUTION and ###END SOLUTION:
+                    ```
+                    {generated_code}
+                    ```
+                    However, the code has an error. The error message is:
+                    ```
+                    {feedback}
+                    ```
+                    Please analyze the error message and fix the code accordingly.
+                    """
+            elif ("executed" in feedback[1].lower()) and (
+                "expected" in feedback[1].lower()
+            ):
+                return """
+                    In the previous attempt, you generated the following code inside the block ###BEGIN SOLUTION and ###END SOLUTION:
+                    ```
+                    {generated_code}
+                    ```
+                    The code executed successfully but failed the test case. Please analyze the difference between the executed result and the expected result to fix the code accordingly. The deviation from the expected result is:
+                    ```
+                    {feedback}
+                    ```
+                    """
+        return ""
 
     def generate(
         self,
@@ -45,34 +171,7 @@ class CodeGenerator:
             Make sure your code is correct and complete to solve the problem.
             """
 
-            if feedback:
-                if "traceback" in feedback[1].lower():
-                    human += """
-                    In the previous attempt, you generated the following code inside the block ###BEGIN SOLUTION and ###END SOLUTION:
-                    ```
-                    {generated_code}
-                    ```
-                    However, the code has an error. The error message is:
-                    ```
-                    {feedback}
-                    ```
-                    Please analyze the error message and fix the code accordingly.
-                    """
-                elif ("executed" in feedback[1].lower()) and (
-                    "expected" in feedback[1].lower()
-                ):
-                    human += """
-                    In the previous attempt, you generated the following code inside the block ###BEGIN SOLUTION and ###END SOLUTION:
-                    ```
-                    {generated_code}
-                    ```
-                    The code executed successfully but failed the test case. Please analyze the difference between the executed result and the expected result to fix the code accordingly. The deviation from the expected result is:
-                    ```
-                    {feedback}
-                    ```
-                    """
-            else:
-                pass
+            human += self._feedback_prompt(feedback)
 
             prompt = ChatPromptTemplate.from_messages(
                 [("system", system), ("human", human)]
@@ -116,39 +215,11 @@ class CodeGenerator:
                 # TODO: Handle this case
                 return ""
         elif self.strategy == "cot":
-            # Retrieve relevant Stack Overflow post
-            post = stack_overflow.retrieve(query=problem, k=1)
-
-            # CoT generation
-            system = "You are a helpful Chain-of-Thought generator that can understand the reasoning behind programming problems and provide step-by-step guidance to solve them."
-            human = """
-            Given the problem description with the code, and a Stack Overflow post, you need to learn from the comments to generate step-by-step suggestions that help another agent to solve the problem.
-
-            The given problem is: {problem_description}.
-
-            The Stack Overflow post with supportive comments is: {post}.
-
-            Please generate a series of suggestions that help another agent to solve the problem step-by-step.
-            Here are some suggestions:
-            - Suggestion 1: [...]
-            - Suggestion 2: [...]
-            - Suggestion 3: [...]
-            - Final suggestion: [...]
-            """
-            prompt = ChatPromptTemplate.from_messages(
-                [("system", system), ("human", human)]
+            # Retrieve the suggestions of the CoT stage
+            cot_suggestions = self.cot.suggest(
+                problem=problem, stack_overflow=stack_overflow
             )
 
-            # Invoke the LLM
-            cot_suggestions = self.llm.invoke(
-                prompt.invoke(
-                    {
-                        "problem_description": problem,
-                        "post": post,
-                    }
-                ),
-            ).content
-
             # CoT strategy
             system = "You are a helpful Self-debugging assistant that can understand and solve programming problems. You have the ability to analyze and execute code, providing feedback and suggestions to help users debug and improve their code. By leveraging your knowledge and expertise, you can assist users in solving complex programming problems and guide them towards writing correct and efficient code. Your goal is to empower users to become better programmers by providing them with valuable insights and assistance throughout their coding journey."
             human = """
@@ -172,20 +243,40 @@ class CodeGenerator:
 
             Make sure your code is correct and complete to solve the problem.
             """
+
+            # Correction attempts reuse the suggestions of the initial attempt
+            human += self._feedback_prompt(feedback)
+
             prompt = ChatPromptTemplate.from_messages(
                 [("system", system), ("human", human)]
             )
 
             # Invoke the LLM
-            answer = self.llm.invoke(
-                prompt.invoke(
-                    {
-                        "problem_description": problem,
-                        "code_context": code_context,
-                        "cot_suggestions": cot_suggestions,
-                    }
-                ),
-            ).content
+            if feedback:
+                try:
+                    answer = self.llm.invoke(
+                        prompt.invoke(
+                            {
+                                "problem_description": problem,
+                                "code_context": code_context,
+                                "cot_suggestions": cot_suggestions,
+                                "generated_code": feedback[0],
+                                "feedback": feedback[1],
+                            }
+                        ),
+                    ).content
+                except openai.BadRequestError:
+                    answer = "assert True # I am sorry, I am unable to generate the code. Please try again later."
+            else:
+                answer = self.llm.invoke(
+                    prompt.invoke(
+                        {
+                            "problem_description": problem,
+                            "code_context": code_context,
+                            "cot_suggestions": cot_suggestions,
+                        }
+                    ),
+                ).content
 
             # Extract code from the answer
             match = re.search(r"```python\n(.*?)\n```", answer, re.DOTALL)
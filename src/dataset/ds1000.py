@@ -1,57 +1,32 @@
+import asyncio
 import configparser
-import importlib
+import importlib.util
 import json
 import os
 import pickle
-import shutil
-import signal
 import sys
 import tempfile
 import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from pathlib import Path
-from subprocess import PIPE, Popen
-from typing import List, Union
-
-from src.utils import setup_test_env
-
-setup_test_env()
-
-
-class Command(object):
-    """
-    This object takes in command and executes it with time out
-    """
-
-    def __init__(self, cmd):
-        self.cmd = cmd
-        self.process = None
-
-    def run(self, timeout):
-        def target():
-            self.process = Popen(
-                self.cmd,
-                shell=True,
-                stdout=PIPE,
-                stderr=PIPE,
-                preexec_fn=os.setsid,
-            )
-            stdout, stderr = self.process.communicate()
-            self.stdout = stdout
-            self.stderr = stderr
-
-        thread = threading.Thread(target=target)
-        thread.start()
-
-        thread.join(timeout)
-        if thread.is_alive():
-            os.killpg(self.process.pid, signal.SIGTERM)
-            thread.join()
-        return (
-            self.process.returncode,
-            self.stdout,
-            self.stderr,
-        )
+from typing import Dict, List, Optional, Union
+
+from src.cache import CACHE_DIR, PersistentCache
+from src.dataset.ds1000_store import (
+    CONTENT_FILES,
+    METADATA,
+    CompiledDS1000,
+    list_problems,
+)
+from src.dataset.executor import CancellationToken, get_executor
+from src.dataset.preflight import preflight, preflight_enabled, preflight_stats
+from src.dataset.sandbox import prepare_sandbox
+from src.dataset.timeouts import OFFICIAL_TIME_LIMIT, get_timeout_policy
+from src.utils import hashes, test_env_fingerprint
 
 
 def import_source_file(fname, modname):
@@ -85,83 +60,149 @@ def import_source_file(fname, modname):
     return module
 
 
+class AnswerCache:
+    """
+    Keeps the unpickled expected answers of the `max_size` most recently tested
+    problems in RAM (all of them if `max_size` is None).
+    """
+
+    def __init__(self, max_size: Optional[int] = None) -> None:
+        self.max_size = max_size
+        self._answers: "OrderedDict[str, list]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, problem: "DS1000Problem") -> list:
+        key = str(problem.problem_path)
+        with self._lock:
+            if key in self._answers:
+                self._answers.move_to_end(key)
+                return self._answers[key]
+
+        answers = problem.load_answers()
+        with self._lock:
+            self._answers[key] = answers
+            self._answers.move_to_end(key)
+            while self.max_size is not None and len(self._answers) > self.max_size:
+                self._answers.popitem(last=False)
+        return answers
+
+    def release(self, problem: "DS1000Problem") -> None:
+        with self._lock:
+            self._answers.pop(str(problem.problem_path), None)
+
+
+# `DS1000_ANSWER_CACHE_SIZE=0` keeps the answers of every problem
+answer_cache = AnswerCache(
+    max_size=int(os.getenv("DS1000_ANSWER_CACHE_SIZE") or 32) or None
+)
+
+
 class DS1000Problem:
     """
     A DS1000 Problem.
 
-    problem = DS1000Problem("ds1000_data/Pandas/Completion/q1") # loads all relevant objects into RAM
+    problem = DS1000Problem("ds1000_data/Pandas/Completion/q1") # loads nothing until accessed
 
     # useful attributes
     problem["prompt"] # official prompt
     problem["reference_code"] # reference_code
     problem.keys() # gives all accessible attributes
+
+    Metadata and content files are read on first access. The expected answers
+    are only unpickled when needed (`problem["ans"]`) and kept in the bounded
+    `answer_cache`; `test` compares the results in the test interpreter.
     """
 
     def __init__(
         self,
         problem_path: Union[str, Path],
+        store: Optional[CompiledDS1000] = None,
+        record: Optional[dict] = None,
     ):
         self.problem_path = Path(problem_path)
         self.problem_id = int(self.problem_path.name.replace("q", ""))
         self.data = dict()
 
+        # the problem may be read from a compiled dataset file instead of its directory
+        self.store = store
+        self.record = record
+
+    def _load_metadata(self):
+        if self.record is not None:
+            self.data.update(self.record["meta"])
+            self.data["source_url"] = ""
+            return
+
         # load meta information in .cfg
         problem_config = configparser.RawConfigParser()
         problem_config.read(self.problem_path / ".cfg")
-        for args in [
-            ("library", "lib"),
-            ("test", "test_type"),
-            ("test", "test_case_cnt"),
-            ("perturbation", "perturbation_type"),
-            ("perturbation", "perturbation_origin_id"),
-        ]:
+        for args in METADATA:
             self.data[args[1]] = problem_config.get(*args)
+        self.data["source_url"] = ""
+
+    def _load_content(self, key: str):
+        if self.record is not None:
+            if key in self.record["fields"]:
+                self.data[key] = self.store.text(self.record["fields"][key])
+            return
 
         # read problem content files
-        for file_name in [
-            "reference_code.txt",
-            "test_code.py",
-            "code_context.txt",
-            "test_generate_pickle.py",
-            "prompt.txt",
-        ]:
-            with open(self.problem_path / file_name, "r", encoding="UTF-8") as f:
-                self.data[file_name.split(".")[0]] = f.read()
+        for file_name in CONTENT_FILES:
+            if file_name.split(".")[0] == key:
+                with open(self.problem_path / file_name, "r", encoding="UTF-8") as f:
+                    self.data[key] = f.read()
+
+    def load_answers(self) -> list:
+        if self.record is not None:
+            return [self.store.answer(span) for span in self.record["ans"]]
 
         # loading precomputed pickles files of inputs and expected outputs
-        self.data["ans"] = []
+        answers = []
 
         # an question may have no input or no answer output
         # in such cases, we put a None object
         # otherwise, we load the pickle file
-        test_cnt = max(int(self.data["test_case_cnt"]), 1)
+        test_cnt = max(int(self["test_case_cnt"]), 1)
         for i in range(1, test_cnt + 1):
             if os.path.exists(self.problem_path / f"ans/ans{i}.pkl"):
                 try:
                     with open(self.problem_path / "ans/ans{}.pkl".format(i), "rb") as f:
                         # with HiddenPrints():
-                        self.data["ans"].append(pickle.load(f))
+                        answers.append(pickle.load(f))
                 except:
-                    self.data["ans"].append(None)
+                    answers.append(None)
             else:
-                self.data["ans"].append(None)
+                answers.append(None)
+        return answers
 
-        self.data["source_url"] = ""
+    def release_answers(self):
+        answer_cache.release(self)
 
     def __getitem__(self, key):
+        if key == "ans":
+            return answer_cache.get(self)
+        if key not in self.data:
+            if key in [args[1] for args in METADATA] + ["source_url"]:
+                self._load_metadata()
+            else:
+                self._load_content(key)
         return self.data[key]
 
     def keys(self):
-        return self.data.keys()
+        return (
+            [args[1] for args in METADATA]
+            + [file_name.split(".")[0] for file_name in CONTENT_FILES]
+            + ["ans", "source_url"]
+        )
 
     def values(self):
-        return self.data.values()
+        return [self[key] for key in self.keys()]
 
     def items(self):
-        return self.data.items()
+        return [(key, self[key]) for key in self.keys()]
 
     def postprocess(self, generated_code: str):
-        if self.data["lib"] == "Matplotlib":
+        if self["lib"] == "Matplotlib":
             code_lines = generated_code.split("\n")
             postprocessed_lines = []
             for line in code_lines:
@@ -185,74 +226,123 @@ class DS1000Problem:
             generated_code = "\n".join(postprocessed_lines)
         return generated_code
 
-    def test(self, generated_code: str):
-        # get current dir because we will enter a temp dir to execute generated code
-        cwd = os.getcwd()
+    def _load_test_module(self, sandbox: Path):
+        # each test loads its own copy of the testing code, so concurrent tests
+        # of any problems never share a module in `sys.modules`
+        modname = f"test_code_{uuid.uuid4().hex}"
+        try:
+            return import_source_file(sandbox / "test_code.py", modname)
+        finally:
+            sys.modules.pop(modname, None)
+
+    def _read_verdict(self, sandbox: Path, i: int) -> dict:
+        # the result is compared with the expected answer by the test
+        # interpreter, see `ds1000_worker.execute_and_compare`
+        try:
+            with open(sandbox / f"result/verdict_{i}.json") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"status": "fail"}
+
+    def _execution_key(self, program: str, i: int) -> str:
+        return hashes(
+            json.dumps(
+                [
+                    "/".join(self.problem_path.parts[-3:]),
+                    program,
+                    i,
+                    test_env_fingerprint(),
+                ]
+            )
+        )
+
+    @staticmethod
+    def _verdict(outcome: dict, program: str):
+        if outcome["status"] == "error":
+            return program, outcome["stderr"]
+        if outcome["status"] == "mismatch":
+            return program, outcome["message"]
+        if outcome["status"] == "fail":
+            return False
+        return True
+
+    def _runtime_key(self, i: int) -> str:
+        # durations depend on whether the libraries are pre-imported
+        executor = type(get_executor()).__name__
+        return f"{'/'.join(self.problem_path.parts[-3:])}:{i}:{executor}"
+
+    def test(
+        self,
+        generated_code: str,
+        official_time_limit: bool = False,
+        use_cache: bool = True,
+        timings: Optional[Dict[str, List[float]]] = None,
+    ):
+        """
+        Execute the test cases of the problem against `generated_code`.
+
+        Test cases are given adaptive time limits derived from their past
+        passing runs, unless `official_time_limit` is set (e.g. for final
+        scoring runs). With `use_cache` False, every test case is executed even
+        if its outcome is cached, and neither its outcome nor its runtime is
+        stored (e.g. for benchmarks). When given, `timings` collects the durations
+        of the phases of the test, see `src/benchmark.py`.
+
+        The process working directory and `sys.modules` are left untouched, so
+        any number of tests may run concurrently from threads.
+        """
+        # Matplotlib requires postprocessing
+        generated_code = self.postprocess(generated_code)
+        program = self["code_context"].replace("[insert]", generated_code)
+
+        # a question may not have test case but we can still execute and see if there is error
+        test_cnt = max(1, int(self["test_case_cnt"]))
+
+        # reuse the outcomes of the test cases this program already went through
+        execution_cache = get_execution_cache()
+        keys = {i: self._execution_key(program, i) for i in range(1, test_cnt + 1)}
+        outcomes = {
+            i: execution_cache.get(key) if use_cache else None
+            for i, key in keys.items()
+        }
+        for i, outcome in outcomes.items():
+            if outcome is not None:
+                verdict = self._verdict(outcome, program)
+                if verdict is not True:
+                    return verdict
+        pending = [i for i, outcome in outcomes.items() if outcome is None]
+        if not pending:
+            # the outcomes are "executed" when the program failed the string test
+            return all(outcome["status"] == "pass" for outcome in outcomes.values())
+
+        # reject the programs that would surely raise without executing them
+        if preflight_enabled():
+            feedback = preflight(self["code_context"], generated_code)
+            preflight_stats.record(feedback is not None, launches=len(pending))
+            if feedback is not None:
+                return program, feedback
+
         # we create a tempdir to execute each generated program
         with tempfile.TemporaryDirectory() as tempdir_name:
             # clean everything in the tempdir (unlikely)
             for file_name in os.listdir(tempdir_name):
-                os.remove(file_name)
+                os.remove(os.path.join(tempdir_name, file_name))
 
+            start = time.perf_counter()
             tempdir_name = Path(tempdir_name)
-            # copy all files and data dependencies from
-            for file_name in os.listdir(self.problem_path):
-                if os.path.isfile(self.problem_path / file_name):
-                    shutil.copy(self.problem_path / file_name, tempdir_name / file_name)
-                elif os.path.isdir(self.problem_path / file_name):
-                    shutil.copytree(
-                        self.problem_path / file_name, tempdir_name / file_name
-                    )
-                else:
-                    raise ValueError("impossible.")
-
+            # link all files and data dependencies from the problem,
             # generated outputs will be put into `result`
-            if os.path.exists(tempdir_name / "result"):
-                shutil.rmtree(tempdir_name / "result")
-            os.mkdir(tempdir_name / "result")
+            prepare_sandbox(self.problem_path, tempdir_name)
 
-            # Matplotlib requires postprocessing
-            generated_code = self.postprocess(generated_code)
-
-            program = self.data["code_context"].replace("[insert]", generated_code)
             with open(tempdir_name / "program.py", "w", encoding="UTF-8") as f:
                 f.write(program)
+            if timings is not None:
+                timings.setdefault("sandbox", []).append(time.perf_counter() - start)
 
-            # enter into the tempdir to execute
-            os.chdir(tempdir_name)
-
-            execution_status = []
-            # a question may not have test case but we can still execute and see if there is error
-            test_cnt = max(1, int(self["test_case_cnt"]))
-            for i in range(1, test_cnt + 1):
-                # notice this command, e.g., you may need to replace `python` with `python3`
-                cmd_text = "{} program.py --test_case {}".format(
-                    os.path.join(
-                        os.path.dirname(
-                            os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-                        ),
-                        ".venv/bin/python",
-                    ),
-                    i,
-                )
-                time_limit = 60  # should not change the official time_limit
-                cmd = Command(
-                    cmd_text,
-                )
-                exit_code, stdout, stderr = cmd.run(
-                    timeout=time_limit
-                )  # 0 if there is no error
-                if exit_code != 0:
-                    return program, stderr.decode("utf-8")
-                execution_status.append(exit_code)
-
-            # check if the generated code can run without error
-            pass_flag = all([status == 0 for status in execution_status])
-
-            # loading testing code as a module
-            test_module = import_source_file(tempdir_name / "test_code.py", "test_code")
-
+            pass_flag = True
             if int(self["test_type"]) == 3:
+                # loading testing code as a module
+                test_module = self._load_test_module(tempdir_name)
                 # stringTest parses the generated code into AST and check AST components
                 # if there is static error, stringTest may raise an exception
                 generated_code = generated_code.split("\n")
@@ -265,42 +355,117 @@ class DS1000Problem:
                 except:
                     pass_flag = False
 
-            for i in range(1, test_cnt + 1):
-                # if the generated program already failed some test, we don't have to compare new test outputs
-                if not pass_flag:
-                    break
+            executor = get_executor()
+            cancellation = CancellationToken()
+            timeout_policy = get_timeout_policy()
+            time_limits = {
+                i: (
+                    OFFICIAL_TIME_LIMIT
+                    if official_time_limit
+                    else timeout_policy.timeout(self._runtime_key(i))
+                )
+                for i in pending
+            }
+
+            def execute(i):
+                return executor.run(
+                    lib=self["lib"],
+                    cwd=str(tempdir_name),
+                    args=["program.py", "--test_case", str(i)],
+                    timeout=time_limits[i],
+                    cancellation=cancellation,
+                    # only a program that passed the string test is compared
+                    compare=bool(pass_flag),
+                )
 
-                # when the generated didn't generate an output, we count it as incorrect
-                if not os.path.exists(f"result/result_{i}.pkl"):
-                    pass_flag = False
-                else:
-                    try:
-                        # loading the generated output might still raise Exception
-                        # if the generated code is not correct
-                        result = pickle.load(
-                            open("result/result_{}.pkl".format(i), "rb")
-                        )
-                        expected_result = self.data["ans"][i - 1]
-                        try:
-                            pass_flag = test_module.test(result, expected_result) == 1
-                            if not pass_flag:
-                                return (
-                                    program,
-                                    f"Executed: \n{result}\nExpected: \n{expected_result}",
+            # test cases run in parallel and are checked as soon as they finish,
+            # the first failure cancels the remaining ones
+            with ThreadPoolExecutor(max_workers=len(pending)) as pool:
+                futures = {pool.submit(execute, i): i for i in pending}
+                try:
+                    for future in as_completed(futures):
+                        i, execution = futures[future], future.result()
+                        if execution.limit == "time":
+                            message = (
+                                f"Timeout: the program did not finish within "
+                                f"{time_limits[i]:.1f}s, it may be too slow or never end"
+                            )
+                            outcome = {"status": "error", "stderr": message}
+                        elif execution.returncode != 0:
+                            stderr = execution.stderr.decode("utf-8")
+                            if execution.limit is not None:
+                                stderr += (
+                                    f"\nKilled: exceeded the {execution.limit} limit"
+                                )
+                            outcome = {"status": "error", "stderr": stderr}
+                        elif not pass_flag:
+                            # if the generated program already failed the string test,
+                            # we only look for execution errors
+                            outcome = {"status": "executed"}
+                        else:
+                            outcome = self._read_verdict(tempdir_name, i)
+                            case_timings = outcome.pop("timings", None)
+                            if timings is not None and case_timings is not None:
+                                # what is not spent in the program is the cost
+                                # of starting and tearing down the interpreter
+                                case_timings["interpreter"] = execution.duration - sum(
+                                    case_timings.values()
                                 )
-                        except:
-                            pass_flag = False
-                    except:
-                        pass_flag = False
-            os.chdir(cwd)
+                                for phase, duration in case_timings.items():
+                                    timings.setdefault(phase, []).append(duration)
+                        outcome["max_rss"] = execution.max_rss
+                        outcome["cpu_time"] = execution.cpu_time
+                        if use_cache and outcome["status"] == "pass":
+                            timeout_policy.record(
+                                self._runtime_key(i), execution.duration
+                            )
+                        # a program killed by a limit may pass on a less loaded
+                        # machine or under a higher limit, it is run again
+                        if use_cache and execution.limit is None:
+                            execution_cache.set(keys[i], outcome)
+
+                        verdict = self._verdict(outcome, program)
+                        if verdict is not True:
+                            return verdict
+                finally:
+                    cancellation.cancel()
+                    for future in futures:
+                        future.cancel()
         return pass_flag
 
+    async def test_async(self, generated_code: str, official_time_limit: bool = False):
+        """
+        `test` for asyncio tasks, run in the default executor of the event loop.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            None, self.test, generated_code, official_time_limit
+        )
+
+
+_execution_cache = None
+_execution_cache_lock = threading.Lock()
+
+
+def get_execution_cache() -> PersistentCache:
+    """
+    Return the process-wide cache of test case outcomes, keyed by problem,
+    program, test case and test interpreter.
+    """
+    global _execution_cache
+    with _execution_cache_lock:
+        if _execution_cache is None:
+            _execution_cache = PersistentCache(
+                os.path.join(CACHE_DIR, "executions.sqlite")
+            )
+        return _execution_cache
+
 
 class DS1000Dataset:
     """
     A DS1000 Dataset.
 
-    ds1000 = DS1000Dataset("ds1000_data") # loads all questions into RAM
+    ds1000 = DS1000Dataset("ds1000_data") # lists all questions, loaded lazily
 
     # DS1000Dataset is splitted by different packages
     ds1000["Pandas"] # list of 291 Pandas questions
@@ -312,6 +477,7 @@ class DS1000Dataset:
         source_dir: Union[str, Path] = "ds1000_data",
         libs: Union[str, List[str]] = "all",
         mode: str = "Insertion",
+        compiled: bool = True,
     ):
         self.source_dir = source_dir
         # to specify which mode to use, ``Insertion'' or ``Completion''
@@ -333,17 +499,25 @@ class DS1000Dataset:
         elif isinstance(libs, list):
             self.libs = libs
 
+        # open the compiled dataset file, built once from the problem directories
+        self.store = (
+            CompiledDS1000.open(source_dir, self.libs, mode) if compiled else None
+        )
+
         self.data = {}
         for lib in self.libs:
             self.data[lib] = []
             source_path = Path(source_dir) / lib / mode
-            problems = sorted(
-                os.listdir(source_path),
-                key=lambda x: int(str(x).replace("q", "")),
-            )
-            for problem in problems:
-                new_problem = DS1000Problem(source_path / problem)
-                self.data[lib].append(new_problem)
+            if self.store is not None:
+                for record in self.store.problems(lib):
+                    new_problem = DS1000Problem(
+                        source_path / record["name"], store=self.store, record=record
+                    )
+                    self.data[lib].append(new_problem)
+            else:
+                for problem in list_problems(source_dir, lib, mode):
+                    new_problem = DS1000Problem(source_path / problem)
+                    self.data[lib].append(new_problem)
 
     def __len__(self):
         return sum([len(self.data[lib]) for lib in self.libs])
@@ -0,0 +1,182 @@
+import configparser
+import json
+import mmap
+import os
+import pickle
+import struct
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+
+from src.cache import CACHE_DIR
+from src.utils import hashes
+
+_MAGIC = b"DS1000C1"
+_HEADER = struct.Struct("<8sQ")
+
+METADATA = [
+    ("library", "lib"),
+    ("test", "test_type"),
+    ("test", "test_case_cnt"),
+    ("perturbation", "perturbation_type"),
+    ("perturbation", "perturbation_origin_id"),
+]
+
+CONTENT_FILES = [
+    "reference_code.txt",
+    "test_code.py",
+    "code_context.txt",
+    "test_generate_pickle.py",
+    "prompt.txt",
+]
+
+
+def list_problems(source_dir: Union[str, Path], lib: str, mode: str) -> List[str]:
+    return sorted(
+        os.listdir(Path(source_dir) / lib / mode),
+        key=lambda x: int(str(x).replace("q", "")),
+    )
+
+
+def fingerprint(source_dir: Union[str, Path], libs: List[str], mode: str) -> str:
+    """
+    Fingerprint the problems of `libs` from the name, size and modification
+    time of every file, without reading them.
+    """
+    entries = []
+    stack = [Path(source_dir) / lib / mode for lib in libs]
+    while stack:
+        for entry in os.scandir(stack.pop()):
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            else:
+                stat = entry.stat()
+                entries.append(f"{entry.path}:{stat.st_size}:{stat.st_mtime_ns}")
+    return hashes("\n".join(sorted(entries)))
+
+
+class CompiledDS1000:
+    """
+    All the problems of a DS-1000 mode packed into a single indexed file.
+
+    The file starts with a header and a JSON index holding the metadata of
+    each problem and the (offset, length) spans of its content files and of
+    its raw `ans` pickles in the blob that follows. The blob is memory-mapped,
+    so opening the file only parses the index and the answers are unpickled
+    straight from the mapping when needed.
+    """
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            magic, index_length = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != _MAGIC:
+                raise ValueError(f"Not a compiled DS-1000 file: {self.path}")
+            self.index = json.loads(f.read(index_length))
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._blob_start = _HEADER.size + index_length
+
+    @property
+    def fingerprint(self) -> str:
+        return self.index["fingerprint"]
+
+    def problems(self, lib: str) -> List[Dict[str, Any]]:
+        return self.index["problems"][lib]
+
+    def _bytes(self, span: List[int]) -> bytes:
+        offset, length = span
+        start = self._blob_start + offset
+        return self._mmap[start : start + length]
+
+    def text(self, span: List[int]) -> str:
+        return self._bytes(span).decode("UTF-8")
+
+    def answer(self, span: Optional[List[int]]) -> Any:
+        # an question may have no answer output, or an unloadable one
+        if span is None:
+            return None
+        try:
+            return pickle.loads(self._bytes(span))
+        except:
+            return None
+
+    @staticmethod
+    def compile(
+        source_dir: Union[str, Path], libs: List[str], mode: str, path: Union[str, Path]
+    ) -> "CompiledDS1000":
+        index = {
+            "fingerprint": fingerprint(source_dir, libs, mode),
+            "mode": mode,
+            "problems": {},
+        }
+        blob = bytearray()
+
+        def append(data: bytes) -> List[int]:
+            blob.extend(data)
+            return [len(blob) - len(data), len(data)]
+
+        for lib in libs:
+            index["problems"][lib] = []
+            for problem in list_problems(source_dir, lib, mode):
+                problem_path = Path(source_dir) / lib / mode / problem
+
+                problem_config = configparser.RawConfigParser()
+                problem_config.read(problem_path / ".cfg")
+                meta = {args[1]: problem_config.get(*args) for args in METADATA}
+
+                fields = {}
+                for file_name in CONTENT_FILES:
+                    with open(problem_path / file_name, "rb") as f:
+                        fields[file_name.split(".")[0]] = append(f.read())
+
+                answers = []
+                test_cnt = max(int(meta["test_case_cnt"]), 1)
+                for i in range(1, test_cnt + 1):
+                    if os.path.exists(problem_path / f"ans/ans{i}.pkl"):
+                        with open(problem_path / f"ans/ans{i}.pkl", "rb") as f:
+                            answers.append(append(f.read()))
+                    else:
+                        answers.append(None)
+
+                index["problems"][lib].append(
+                    {
+                        "name": problem,
+                        "meta": meta,
+                        "fields": fields,
+                        "ans": answers,
+                    }
+                )
+
+        encoded_index = json.dumps(index).encode("UTF-8")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, len(encoded_index)))
+            f.write(encoded_index)
+            f.write(blob)
+        os.replace(tmp_path, path)
+        return CompiledDS1000(path)
+
+    @staticmethod
+    def open(
+        source_dir: Union[str, Path], libs: List[str], mode: str
+    ) -> "CompiledDS1000":
+        """
+        Open the compiled file of `source_dir`, (re)compiling it when it is
+        missing or when the dataset no longer matches its fingerprint.
+        """
+        path = os.path.join(
+            CACHE_DIR,
+            f"ds1000_{hashes(str(Path(source_dir).absolute()))}_{mode}.bin",
+        )
+        if os.path.exists(path):
+            try:
+                store = CompiledDS1000(path)
+                if set(libs) <= set(
+                    store.index["problems"]
+                ) and store.fingerprint == fingerprint(
+                    source_dir, list(store.index["problems"]), mode
+                ):
+                    return store
+            except ValueError:
+                pass
+        return CompiledDS1000.compile(source_dir, libs, mode, path)
@@ -0,0 +1,472 @@
+"""
+A warm interpreter for DS-1000 test executions.
+
+This script runs inside the test interpreter (`.venv/bin/python`), so it only
+depends on the standard library. It prepares a template process for a DS-1000
+library once (heavy libraries imported, non-interactive Matplotlib backend,
+seeded RNGs), then forks a fresh child from it per request to execute the
+program, keeping test executions isolated from each other.
+
+The worker announces itself with `{"ready": true, "profile": ...}`, where the
+profile holds the import time of each module and the memory of the template.
+
+The protocol is line-based JSON over stdin/stdout. A request is
+`{"cwd": ..., "argv": [...], "timeout": ..., "limits": {...}, "cgroup": ...,
+"compare": ...}`; the worker answers with `{"pid": ...}` once the child is
+started, then with `{"returncode": ..., "stdout": ..., "stderr": ...,
+"timed_out": ..., "max_rss": ..., "cpu_time": ..., "duration": ...}` where the
+outputs are base64-encoded bytes.
+
+With `compare`, the child also compares the result of the program with the
+expected answer, see `execute_and_compare`. `python ds1000_worker.py --compare
+program.py ...` does the same in a brand-new interpreter.
+
+The resource limits helpers are also used by the executor for brand-new
+interpreters, so they only depend on the standard library as well.
+"""
+
+import argparse
+import base64
+import builtins
+import importlib
+import importlib.util
+import json
+import mmap
+import os
+import pickle
+import random
+import resource
+import runpy
+import signal
+import sys
+import tempfile
+import time
+import traceback
+
+LIB_IMPORTS = {
+    "Pandas": ["numpy", "pandas"],
+    "Numpy": ["numpy"],
+    "Matplotlib": ["numpy", "pandas", "matplotlib", "matplotlib.pyplot"],
+    "Tensorflow": ["numpy", "tensorflow"],
+    "Scipy": [
+        "numpy",
+        "scipy",
+        "scipy.integrate",
+        "scipy.interpolate",
+        "scipy.optimize",
+        "scipy.sparse",
+        "scipy.spatial",
+        "scipy.stats",
+    ],
+    "Sklearn": ["numpy", "pandas", "sklearn"],
+    "Pytorch": ["numpy", "torch"],
+}
+
+# Seeding functions of the RNGs of the imported libraries
+_SEEDS = [
+    ("numpy", "random.seed"),
+    ("torch", "manual_seed"),
+    ("tensorflow", "random.set_seed"),
+]
+
+# SIGTERM grace period before the child's process group is killed
+_KILL_GRACE = 1.0
+
+# Characters of the executed and expected results kept in a mismatch message
+_MESSAGE_LIMIT = 2000
+
+
+_RLIMITS = [
+    ("cpu_time", resource.RLIMIT_CPU),
+    ("address_space", resource.RLIMIT_AS),
+    ("open_files", resource.RLIMIT_NOFILE),
+]
+
+
+def apply_limits(limits):
+    """
+    Apply the `setrlimit` limits of a test execution to the current process.
+    """
+    for name, rlimit in _RLIMITS:
+        value = limits.get(name)
+        if not value:
+            continue
+        _, hard = resource.getrlimit(rlimit)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        # SIGXCPU is sent at the soft CPU limit, SIGKILL one second later
+        if rlimit == resource.RLIMIT_CPU and (
+            hard == resource.RLIM_INFINITY or value < hard
+        ):
+            resource.setrlimit(rlimit, (value, value + 1))
+        else:
+            resource.setrlimit(rlimit, (value, value))
+
+
+def enter_cgroup(cgroup):
+    """
+    Move the current process into the cgroup v2 at path `cgroup`.
+    """
+    with open(os.path.join(cgroup, "cgroup.procs"), "w") as f:
+        f.write("0")
+
+
+def usage(rusage):
+    """
+    Return the peak RSS (bytes) and CPU time (seconds) of a `wait4` rusage.
+    """
+    return rusage.ru_maxrss * 1024, rusage.ru_utime + rusage.ru_stime
+
+
+def status_returncode(status):
+    """
+    Return the returncode of a `wait` status, negative for a signal like `Popen`.
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _execute(argv):
+    """
+    Run a program the way `python program.py ...` would, in the child.
+    """
+    program = argv[0]
+    sys.argv = list(argv)
+    sys.path[0] = os.path.dirname(os.path.abspath(program))
+    try:
+        runpy.run_path(program, run_name="__main__")
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=sys.stderr)
+        return 1
+    except BaseException as e:
+        # Hide the frames of this worker from the traceback
+        tb = e.__traceback__
+        while tb is not None and tb.tb_frame.f_code.co_filename != program:
+            tb = tb.tb_next
+        traceback.print_exception(type(e), e, _strip_worker_frames(tb))
+        return 1
+    return 0
+
+
+def _strip_worker_frames(tb):
+    # e.g. the frames of the import timer, in the middle of the program's ones
+    worker = _strip_worker_frames.__code__.co_filename
+    head = tb
+    while tb is not None:
+        next_tb = tb.tb_next
+        while next_tb is not None and next_tb.tb_frame.f_code.co_filename == worker:
+            next_tb = next_tb.tb_next
+        tb.tb_next = next_tb
+        tb = next_tb
+    return head
+
+
+class _ImportTimer:
+    """
+    Replaces `__import__` to measure the time spent in the imports of a
+    program, nested imports included.
+    """
+
+    def __init__(self):
+        self.total = 0.0
+        self._depth = 0
+        self._import = builtins.__import__
+
+    def __call__(self, *args, **kwargs):
+        if self._depth:
+            return self._import(*args, **kwargs)
+        self._depth += 1
+        start = time.perf_counter()
+        try:
+            return self._import(*args, **kwargs)
+        finally:
+            self.total += time.perf_counter() - start
+            self._depth -= 1
+
+    def __enter__(self):
+        builtins.__import__ = self
+        return self
+
+    def __exit__(self, *exc):
+        builtins.__import__ = self._import
+
+
+def _load_answer(path):
+    # an question may have no answer output, or an unloadable one
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+    try:
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as answer:
+                return pickle.loads(answer)
+    except Exception:
+        return None
+
+
+def _load_test_code(path):
+    spec = importlib.util.spec_from_file_location("test_code", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _bounded(value):
+    text = str(value)
+    if len(text) > _MESSAGE_LIMIT:
+        text = (
+            text[:_MESSAGE_LIMIT]
+            + f"\n... ({len(text) - _MESSAGE_LIMIT} more characters)"
+        )
+    return text
+
+
+def _compare(result_path, answer_path, captured, timings):
+    start = time.perf_counter()
+    if captured:
+        try:
+            result = pickle.loads(captured[-1])
+        except Exception:
+            return {"status": "fail"}
+    elif os.path.exists(result_path) and os.path.getsize(result_path) > 0:
+        # the result was not written with `pickle.dump`
+        try:
+            with open(result_path, "rb") as f:
+                result = pickle.load(f)
+        except Exception:
+            return {"status": "fail"}
+    else:
+        # when the generated didn't generate an output, we count it as incorrect
+        return {"status": "fail"}
+    timings["result_load"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    expected = _load_answer(answer_path)
+    timings["answer_load"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    try:
+        test_module = _load_test_code("test_code.py")
+        if test_module.test(result, expected) != 1:
+            return {
+                "status": "mismatch",
+                "message": f"Executed: \n{_bounded(result)}\nExpected: \n{_bounded(expected)}",
+            }
+    except Exception:
+        return {"status": "fail"}
+    finally:
+        timings["comparison"] = time.perf_counter() - start
+    return {"status": "pass"}
+
+
+def execute_and_compare(argv):
+    """
+    Run a program like `_execute`, then compare its result with the expected
+    answer of the test case using `test_code.test`, in the current directory.
+
+    The result is pickled in memory by the `pickle.dump` call writing
+    `result/result_{i}.pkl` instead of going through the disk, the expected
+    answer is unpickled from a memory mapping of `ans/ans{i}.pkl`. Only the
+    verdict is written to `result/verdict_{i}.json`, along with the time spent
+    in each phase of the test case.
+    """
+    test_case = int(argv[argv.index("--test_case") + 1])
+    result_path = os.path.abspath(f"result/result_{test_case}.pkl")
+    captured = []
+    dump = pickle.dump
+    dump_time = [0.0]
+
+    def capture(obj, file, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            name = getattr(file, "name", None)
+            if isinstance(name, str) and os.path.abspath(name) == result_path:
+                # pickle now, like writing the file would: unpicklable results
+                # raise, and later mutations of the object are not seen
+                captured.append(pickle.dumps(obj, *args, **kwargs))
+                return
+            dump(obj, file, *args, **kwargs)
+        finally:
+            dump_time[0] += time.perf_counter() - start
+
+    pickle.dump = capture
+    start = time.perf_counter()
+    try:
+        with _ImportTimer() as import_timer:
+            code = _execute(argv)
+    finally:
+        pickle.dump = dump
+    timings = {
+        "imports": import_timer.total,
+        "result_dump": dump_time[0],
+        "user_code": time.perf_counter() - start - import_timer.total - dump_time[0],
+    }
+    if code == 0:
+        verdict = _compare(result_path, f"ans/ans{test_case}.pkl", captured, timings)
+        verdict["timings"] = timings
+        with open(f"result/verdict_{test_case}.json", "w") as f:
+            json.dump(verdict, f)
+    return code
+
+
+def _run_child(request, stdout_fd, stderr_fd):
+    os.setsid()
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.dup2(stdout_fd, 1)
+    os.dup2(stderr_fd, 2)
+
+    code = 1
+    try:
+        # The child must never return into the serving loop
+        os.chdir(request["cwd"])
+        if request.get("cgroup"):
+            enter_cgroup(request["cgroup"])
+        apply_limits(request.get("limits") or {})
+        if request.get("compare"):
+            code = execute_and_compare(request["argv"])
+        else:
+            code = _execute(request["argv"])
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+
+def _wait(pid, timeout):
+    """
+    Wait for the child, return its status, rusage and whether it timed out.
+    """
+    deadline = time.monotonic() + timeout
+    delay = 0.001
+    while True:
+        finished, status, rusage = os.wait4(pid, os.WNOHANG)
+        if finished:
+            return status, rusage, False
+        if time.monotonic() >= deadline:
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, 0.02)
+
+    # Time out: terminate the whole process group of the child
+    os.killpg(pid, signal.SIGTERM)
+    deadline = time.monotonic() + _KILL_GRACE
+    while time.monotonic() < deadline:
+        finished, status, rusage = os.wait4(pid, os.WNOHANG)
+        if finished:
+            return status, rusage, True
+        time.sleep(0.01)
+    os.killpg(pid, signal.SIGKILL)
+    _, status, rusage = os.wait4(pid, 0)
+    return status, rusage, True
+
+
+def _read(f):
+    f.seek(0)
+    return base64.b64encode(f.read()).decode("ascii")
+
+
+def _seed_rngs(seed=0):
+    random.seed(seed)
+    for module, function in _SEEDS:
+        # only seed the libraries the template imported
+        if module not in sys.modules:
+            continue
+        try:
+            seed_function = sys.modules[module]
+            for attribute in function.split("."):
+                seed_function = getattr(seed_function, attribute)
+            seed_function(seed)
+        except Exception:
+            pass
+
+
+def _prepare_template(lib):
+    """
+    Import the libraries of `lib` and seed their RNGs, the state every child
+    is forked from. Return the import-time profile of the template.
+    """
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    imports = {}
+    for module in LIB_IMPORTS.get(lib, []):
+        start = time.perf_counter()
+        try:
+            importlib.import_module(module)
+        except Exception:
+            continue
+        imports[module] = time.perf_counter() - start
+    _seed_rngs()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {
+        "imports": imports,
+        "import_time": sum(imports.values()),
+        "import_rss": rss_after - rss_before,
+        "max_rss": rss_after,
+    }
+
+
+def serve(lib):
+    # Keep the protocol channel away from anything printed by the libraries
+    protocol = os.fdopen(os.dup(1), "w")
+    os.dup2(2, 1)
+
+    profile = _prepare_template(lib)
+
+    protocol.write(json.dumps({"ready": True, "profile": profile}) + "\n")
+    protocol.flush()
+
+    for line in sys.stdin:
+        request = json.loads(line)
+        with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            start = time.monotonic()
+            pid = os.fork()
+            if pid == 0:
+                protocol.close()
+                _run_child(request, stdout.fileno(), stderr.fileno())
+
+            protocol.write(json.dumps({"pid": pid}) + "\n")
+            protocol.flush()
+
+            status, rusage, timed_out = _wait(pid, request["timeout"])
+            duration = time.monotonic() - start
+            max_rss, cpu_time = usage(rusage)
+            protocol.write(
+                json.dumps(
+                    {
+                        "returncode": status_returncode(status),
+                        "stdout": _read(stdout),
+                        "stderr": _read(stderr),
+                        "timed_out": timed_out,
+                        "max_rss": max_rss,
+                        "cpu_time": cpu_time,
+                        "duration": duration,
+                    }
+                )
+                + "\n"
+            )
+            protocol.flush()
+
+
+if __name__ == "__main__":
+    # Figures are saved by the programs, never shown
+    os.environ.setdefault("MPLBACKEND", "Agg")
+
+    if sys.argv[1:2] == ["--compare"]:
+        # A brand-new interpreter executing a single test case
+        sys.exit(execute_and_compare(sys.argv[2:]))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lib", type=str, required=True)
+    args = parser.parse_args()
+    serve(args.lib)
@@ -0,0 +1,617 @@
+import atexit
+import base64
+import json
+import os
+import signal
+import threading
+import time
+import uuid
+from collections import Counter
+from queue import Empty, Queue
+from subprocess import DEVNULL, PIPE, Popen
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+from src.dataset.ds1000_worker import (
+    apply_limits,
+    enter_cgroup,
+    status_returncode,
+    usage,
+)
+from src.utils import PROJECT_ROOT, setup_test_env
+
+TEST_PYTHON = os.path.join(PROJECT_ROOT, ".venv/bin/python")
+WORKER_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "ds1000_worker.py"
+)
+
+
+class CancellationToken:
+    """
+    Cancels a group of executions: running ones are killed, pending ones
+    return immediately.
+    """
+
+    def __init__(self) -> None:
+        self.cancelled = False
+        self._callbacks: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def register(self, callback: Callable[[], None]) -> None:
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def unregister(self, callback: Callable[[], None]) -> None:
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def cancel(self) -> None:
+        with self._lock:
+            self.cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+def _kill_process_group(pid: int) -> Callable[[], None]:
+    def kill() -> None:
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    return kill
+
+
+class Command(object):
+    """
+    This object takes in command and executes it with time out
+    """
+
+    def __init__(
+        self,
+        cmd,
+        cwd: Optional[str] = None,
+        preexec_fn: Callable[[], None] = os.setsid,
+    ):
+        self.cmd = cmd
+        self.cwd = cwd
+        self.preexec_fn = preexec_fn
+        self.process = None
+        self.rusage = None
+        self.timed_out = False
+
+    def run(self, timeout, cancellation: Optional[CancellationToken] = None):
+        def target():
+            self.process = Popen(
+                self.cmd,
+                shell=True,
+                stdout=PIPE,
+                stderr=PIPE,
+                cwd=self.cwd,
+                preexec_fn=self.preexec_fn,
+            )
+            kill = _kill_process_group(self.process.pid)
+            if cancellation is not None:
+                cancellation.register(kill)
+            # Read both pipes until they close, then reap the process with
+            # wait4 to keep its resource usage
+            stderr = []
+            reader = threading.Thread(
+                target=lambda: stderr.append(self.process.stderr.read())
+            )
+            reader.start()
+            self.stdout = self.process.stdout.read()
+            reader.join()
+            self.stderr = stderr[0]
+            self.process.stdout.close()
+            self.process.stderr.close()
+            _, status, self.rusage = os.wait4(self.process.pid, 0)
+            self.process.returncode = status_returncode(status)
+            if cancellation is not None:
+                cancellation.unregister(kill)
+
+        thread = threading.Thread(target=target)
+        thread.start()
+
+        thread.join(timeout)
+        if thread.is_alive():
+            self.timed_out = True
+            os.killpg(self.process.pid, signal.SIGTERM)
+            thread.join()
+        return (
+            self.process.returncode,
+            self.stdout,
+            self.stderr,
+        )
+
+
+class ResourceLimits(NamedTuple):
+    cpu_time: Optional[int] = 120  # seconds
+    # RLIMIT_AS counts virtual memory, which numpy, torch and tensorflow reserve
+    # far beyond what they use, so memory is better capped with a cgroup
+    address_space: Optional[int] = None  # bytes
+    open_files: Optional[int] = 1024
+    memory: Optional[int] = None  # bytes, cgroup v2 `memory.max`
+
+    @staticmethod
+    def from_env() -> "ResourceLimits":
+        """
+        Read the limits from `DS1000_CPU_LIMIT` (seconds),
+        `DS1000_ADDRESS_SPACE_LIMIT` (MiB), `DS1000_OPEN_FILES_LIMIT` and
+        `DS1000_CGROUP_MEMORY_LIMIT` (MiB), where 0 disables a limit.
+        """
+        defaults = ResourceLimits()
+
+        def read(name: str, default: Optional[int], unit: int = 1) -> Optional[int]:
+            value = os.getenv(name)
+            if not value:
+                return default
+            return int(value) * unit or None
+
+        return ResourceLimits(
+            cpu_time=read("DS1000_CPU_LIMIT", defaults.cpu_time),
+            address_space=read(
+                "DS1000_ADDRESS_SPACE_LIMIT", defaults.address_space, 1 << 20
+            ),
+            open_files=read("DS1000_OPEN_FILES_LIMIT", defaults.open_files),
+            memory=read("DS1000_CGROUP_MEMORY_LIMIT", defaults.memory, 1 << 20),
+        )
+
+    def rlimits(self) -> dict:
+        return {
+            "cpu_time": self.cpu_time,
+            "address_space": self.address_space,
+            "open_files": self.open_files,
+        }
+
+
+class MemoryCgroup:
+    """
+    A cgroup v2 capping the memory of a single test execution.
+
+    It is created under `DS1000_CGROUP_ROOT`, a cgroup delegated to the
+    current user with the memory controller available (e.g. from
+    `systemd-run --user --scope -p Delegate=yes`).
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    @staticmethod
+    def create(limit: Optional[int]) -> Optional["MemoryCgroup"]:
+        root = os.getenv("DS1000_CGROUP_ROOT")
+        if not limit or not root:
+            return None
+        path = os.path.join(root, f"ds1000-{uuid.uuid4().hex}")
+        try:
+            try:
+                with open(os.path.join(root, "cgroup.subtree_control"), "w") as f:
+                    f.write("+memory")
+            except OSError:
+                # Already enabled, or not allowed to be
+                pass
+            os.mkdir(path)
+        except OSError:
+            return None
+        cgroup = MemoryCgroup(path)
+        try:
+            cgroup._write("memory.max", str(limit))
+            cgroup._write("memory.swap.max", "0")
+        except OSError:
+            if not os.path.exists(os.path.join(path, "memory.max")):
+                cgroup.remove()
+                return None
+        return cgroup
+
+    def _write(self, name: str, value: str) -> None:
+        with open(os.path.join(self.path, name), "w") as f:
+            f.write(value)
+
+    def enter(self) -> None:
+        enter_cgroup(self.path)
+
+    def oom_killed(self) -> bool:
+        try:
+            with open(os.path.join(self.path, "memory.events")) as f:
+                events = dict(line.split() for line in f)
+        except OSError:
+            return False
+        return int(events.get("oom_kill", 0)) > 0
+
+    def remove(self) -> None:
+        try:
+            # Kill the processes left behind by the execution (Linux 5.14+)
+            self._write("cgroup.kill", "1")
+        except OSError:
+            pass
+        try:
+            os.rmdir(self.path)
+        except OSError:
+            pass
+
+
+class ExecutionResult(NamedTuple):
+    returncode: int
+    stdout: bytes
+    stderr: bytes
+    limit: Optional[str] = None  # the limit that killed the execution
+    max_rss: int = 0  # bytes
+    cpu_time: float = 0.0  # seconds
+    duration: float = 0.0  # wall-clock seconds
+
+
+# Returned for executions cancelled before they started
+_CANCELLED = ExecutionResult(-signal.SIGKILL, b"", b"")
+
+# Errors of programs stopped by the address space and open files limits
+_LIMIT_ERRORS = [
+    ("address_space", [b"MemoryError", b"Unable to allocate", b"std::bad_alloc"]),
+    ("open_files", [b"Too many open files"]),
+]
+
+
+def _exceeded_limit(
+    returncode: int,
+    stderr: bytes,
+    cpu_time: float,
+    limits: ResourceLimits,
+    timed_out: bool,
+    cgroup: Optional[MemoryCgroup],
+) -> Optional[str]:
+    if returncode == 0:
+        return None
+    if timed_out:
+        return "time"
+    if cgroup is not None and cgroup.oom_killed():
+        return "memory"
+    # the shell running the program reports a signal as 128 + signal number
+    if returncode in (-signal.SIGXCPU, 128 + signal.SIGXCPU) or (
+        limits.cpu_time and cpu_time >= limits.cpu_time
+    ):
+        return "cpu_time"
+    for limit, errors in _LIMIT_ERRORS:
+        if getattr(limits, limit) and any(error in stderr for error in errors):
+            return limit
+    return None
+
+
+class ResourceUsage:
+    """
+    Aggregates the resource usage of the test executions.
+    """
+
+    def __init__(self) -> None:
+        self.executions = 0
+        self.peak_rss = 0
+        self.cpu_time = 0.0
+        self.killed: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, result: ExecutionResult) -> None:
+        with self._lock:
+            self.executions += 1
+            self.peak_rss = max(self.peak_rss, result.max_rss)
+            self.cpu_time += result.cpu_time
+            if result.limit is not None:
+                self.killed[result.limit] += 1
+
+    def summary(self) -> str:
+        mean_cpu_time = self.cpu_time / self.executions if self.executions else 0.0
+        killed = ", ".join(f"{k}: {v}" for k, v in sorted(self.killed.items()))
+        return (
+            f"{self.executions} executions, "
+            f"peak RSS {self.peak_rss / (1 << 20):.1f} MiB, "
+            f"mean CPU time {mean_cpu_time:.3f}s, "
+            f"killed by limits: {killed or 'none'}"
+        )
+
+
+resource_usage = ResourceUsage()
+
+
+class SubprocessExecutor:
+    """
+    Executes every test case in a brand-new interpreter.
+    """
+
+    def __init__(
+        self, python: str = TEST_PYTHON, limits: Optional[ResourceLimits] = None
+    ) -> None:
+        self.python = python
+        self.limits = limits or ResourceLimits()
+
+    def run(
+        self,
+        lib: str,
+        cwd: str,
+        args: List[str],
+        timeout: float,
+        cancellation: Optional[CancellationToken] = None,
+        compare: bool = False,
+    ) -> ExecutionResult:
+        if cancellation is not None and cancellation.cancelled:
+            return _CANCELLED
+        if compare:
+            args = [WORKER_PATH, "--compare"] + args
+        cgroup = MemoryCgroup.create(self.limits.memory)
+
+        def preexec_fn() -> None:
+            os.setsid()
+            if cgroup is not None:
+                cgroup.enter()
+            apply_limits(self.limits.rlimits())
+
+        cmd = Command(" ".join([self.python] + args), cwd=cwd, preexec_fn=preexec_fn)
+        try:
+            start = time.perf_counter()
+            exit_code, stdout, stderr = cmd.run(
+                timeout=timeout, cancellation=cancellation
+            )
+            duration = time.perf_counter() - start
+            max_rss, cpu_time = usage(cmd.rusage) if cmd.rusage else (0, 0.0)
+            limit = _exceeded_limit(
+                exit_code, stderr, cpu_time, self.limits, cmd.timed_out, cgroup
+            )
+        finally:
+            if cgroup is not None:
+                cgroup.remove()
+        result = ExecutionResult(
+            exit_code, stdout, stderr, limit, max_rss, cpu_time, duration
+        )
+        resource_usage.record(result)
+        return result
+
+    def profile_report(self) -> Dict[str, dict]:
+        # every execution pays for its imports
+        return {}
+
+    def close(self) -> None:
+        pass
+
+
+class WarmInterpreter:
+    """
+    A long-lived test interpreter that has pre-imported the heavy libraries of
+    a DS-1000 library and forks a fresh child per test case, see
+    `ds1000_worker.py`.
+    """
+
+    def __init__(
+        self,
+        lib: str,
+        python: str = TEST_PYTHON,
+        limits: Optional[ResourceLimits] = None,
+    ) -> None:
+        self.lib = lib
+        self.python = python
+        self.limits = limits or ResourceLimits()
+        self.process = None
+        self.profile: Dict[str, Any] = {}
+        self.start()
+
+    def start(self) -> None:
+        self.process = Popen(
+            [self.python, WORKER_PATH, "--lib", self.lib],
+            stdin=PIPE,
+            stdout=PIPE,
+            stderr=DEVNULL,
+            cwd=PROJECT_ROOT,
+        )
+        # Wait for the libraries to be imported
+        self.profile = self._receive().get("profile", {})
+
+    def _receive(self) -> dict:
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError(f"The {self.lib} interpreter exited unexpectedly")
+        return json.loads(line)
+
+    def run(
+        self,
+        cwd: str,
+        args: List[str],
+        timeout: float,
+        cancellation: Optional[CancellationToken] = None,
+        compare: bool = False,
+    ) -> ExecutionResult:
+        if self.process.poll() is not None:
+            self.start()
+
+        cgroup = MemoryCgroup.create(self.limits.memory)
+        request = {
+            "cwd": cwd,
+            "argv": args,
+            "timeout": timeout,
+            "limits": self.limits.rlimits(),
+            "cgroup": cgroup.path if cgroup is not None else None,
+            "compare": compare,
+        }
+        try:
+            return self._request(request, cgroup, cancellation)
+        finally:
+            if cgroup is not None:
+                cgroup.remove()
+
+    def _request(
+        self,
+        request: dict,
+        cgroup: Optional[MemoryCgroup],
+        cancellation: Optional[CancellationToken],
+    ) -> ExecutionResult:
+        self.process.stdin.write((json.dumps(request) + "\n").encode())
+        self.process.stdin.flush()
+
+        kill = _kill_process_group(self._receive()["pid"])
+        if cancellation is not None:
+            cancellation.register(kill)
+        try:
+            response = self._receive()
+        finally:
+            if cancellation is not None:
+                cancellation.unregister(kill)
+        stderr = base64.b64decode(response["stderr"])
+        result = ExecutionResult(
+            response["returncode"],
+            base64.b64decode(response["stdout"]),
+            stderr,
+            _exceeded_limit(
+                response["returncode"],
+                stderr,
+                response["cpu_time"],
+                self.limits,
+                response["timed_out"],
+                cgroup,
+            ),
+            response["max_rss"],
+            response["cpu_time"],
+            response["duration"],
+        )
+        resource_usage.record(result)
+        return result
+
+    def close(self) -> None:
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            try:
+                self.process.wait(timeout=5)
+            except Exception:
+                self.process.kill()
+
+
+class WarmInterpreterPool:
+    """
+    Keeps up to `size` warm interpreters per DS-1000 library, started lazily.
+
+    `run` has the same stdout/stderr/exit-code contract as `Command.run`.
+    """
+
+    def __init__(
+        self,
+        size: int = 2,
+        python: str = TEST_PYTHON,
+        limits: Optional[ResourceLimits] = None,
+    ) -> None:
+        self.size = size
+        self.python = python
+        self.limits = limits or ResourceLimits()
+        self._idle: Dict[str, Queue] = {}
+        self._started: Dict[str, int] = {}
+        self._executions: Counter = Counter()
+        self._workers: List[WarmInterpreter] = []
+        self._lock = threading.Lock()
+
+    def _checkout(self, lib: str) -> WarmInterpreter:
+        with self._lock:
+            idle = self._idle.setdefault(lib, Queue())
+            try:
+                return idle.get_nowait()
+            except Empty:
+                pass
+            start = self._started.get(lib, 0) < self.size
+            if start:
+                self._started[lib] = self._started.get(lib, 0) + 1
+        if start:
+            try:
+                worker = WarmInterpreter(
+                    lib=lib, python=self.python, limits=self.limits
+                )
+            except Exception:
+                with self._lock:
+                    self._started[lib] -= 1
+                raise
+            with self._lock:
+                self._workers.append(worker)
+            return worker
+        return idle.get()
+
+    def run(
+        self,
+        lib: str,
+        cwd: str,
+        args: List[str],
+        timeout: float,
+        cancellation: Optional[CancellationToken] = None,
+        compare: bool = False,
+    ) -> ExecutionResult:
+        worker = self._checkout(lib)
+        with self._lock:
+            self._executions[lib] += 1
+        try:
+            if cancellation is not None and cancellation.cancelled:
+                return _CANCELLED
+            try:
+                return worker.run(cwd, args, timeout, cancellation, compare)
+            except RuntimeError:
+                # The interpreter died (e.g. killed by the OOM killer), retry once
+                worker.start()
+                return worker.run(cwd, args, timeout, cancellation, compare)
+        finally:
+            self._idle[lib].put(worker)
+
+    def profile_report(self) -> Dict[str, dict]:
+        """
+        The import-time profile of the template of each library, and the time
+        the template saved by sparing these imports to its executions.
+        """
+        report = {}
+        with self._lock:
+            for worker in self._workers:
+                if worker.lib in report or not worker.profile:
+                    continue
+                report[worker.lib] = dict(
+                    worker.profile,
+                    executions=self._executions[worker.lib],
+                    saved_time=worker.profile["import_time"]
+                    * self._executions[worker.lib],
+                )
+        return report
+
+    def close(self) -> None:
+        with self._lock:
+            for worker in self._workers:
+                worker.close()
+            self._workers = []
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Return the process-wide test executor.
+
+    `DS1000_EXECUTOR` selects between the warm interpreter pool (`warm`, the
+    default) and a brand-new interpreter per test case (`subprocess`). Both
+    apply the resource limits of `ResourceLimits.from_env`.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # The test interpreter is only set up once a test is executed
+            setup_test_env()
+            limits = ResourceLimits.from_env()
+            if os.getenv("DS1000_EXECUTOR", "warm") == "subprocess":
+                _executor = SubprocessExecutor(limits=limits)
+            else:
+                _executor = WarmInterpreterPool(
+                    size=int(
+                        os.getenv("DS1000_WARM_WORKERS") or min(4, os.cpu_count() or 1)
+                    ),
+                    limits=limits,
+                )
+            atexit.register(_executor.close)
+        return _executor
+
+
+def current_executor():
+    """
+    Return the process-wide test executor if it was created, without creating
+    it (nor setting up the test interpreter).
+    """
+    with _executor_lock:
+        return _executor
@@ -0,0 +1,198 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Optional, Tuple
+
+from minio import Minio
+
+from src.dataset.minio_helper import Progress
+
+logger = logging.getLogger(__name__)
+
+_COPY_SIZE = 1 << 20
+
+
+class Part(NamedTuple):
+    path: str
+    start: int
+    end: int  # exclusive
+
+
+class Download(NamedTuple):
+    object_name: str
+    file_path: str
+    size: int
+    etag: str
+    parts: List[Part]
+
+
+class ChecksumError(Exception):
+    pass
+
+
+class RangedDownloader:
+    """
+    Downloads objects from MinIO (or any S3-compatible store) in byte-range
+    parts fetched concurrently, sharing one `Progress`.
+
+    Parts are written next to the target file, in `<file_path>.parts`, so an
+    interrupted download resumes where each part stopped, as long as the
+    object did not change (same ETag). Once complete, the parts are joined
+    and checked against the size and, for single-part uploads, the ETag (the
+    MD5 of the object).
+    """
+
+    def __init__(
+        self,
+        client: Minio,
+        bucket_name: str,
+        part_size: int = 64 << 20,
+        workers: int = 8,
+        retries: int = 3,
+    ) -> None:
+        self.client = client
+        self.bucket_name = bucket_name
+        self.part_size = part_size
+        self.workers = workers
+        self.retries = retries
+
+    def _parts(self, file_path: str, size: int, etag: str) -> List[Part]:
+        parts_dir = file_path + ".parts"
+        meta_path = os.path.join(parts_dir, "meta.json")
+        meta = {"etag": etag, "size": size, "part_size": self.part_size}
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                if json.load(f) != meta:
+                    # The object changed, or was split differently
+                    shutil.rmtree(parts_dir)
+        os.makedirs(parts_dir, exist_ok=True)
+        with open(meta_path, "w") as f:
+            json.dump(meta, f)
+
+        return [
+            Part(
+                path=os.path.join(parts_dir, str(i)),
+                start=start,
+                end=min(start + self.part_size, size),
+            )
+            for i, start in enumerate(range(0, size, self.part_size))
+        ]
+
+    @staticmethod
+    def _downloaded(part: Part) -> int:
+        if not os.path.exists(part.path):
+            return 0
+        return min(os.path.getsize(part.path), part.end - part.start)
+
+    def _fetch(self, object_name: str, part: Part, progress: Progress) -> None:
+        for attempt in range(self.retries + 1):
+            downloaded = self._downloaded(part)
+            if downloaded == part.end - part.start:
+                return
+            response = None
+            try:
+                response = self.client.get_object(
+                    self.bucket_name,
+                    object_name,
+                    offset=part.start + downloaded,
+                    length=part.end - part.start - downloaded,
+                )
+                with open(part.path, "ab") as f:
+                    for data in response.stream(_COPY_SIZE):
+                        f.write(data)
+                        progress.update(len(data))
+                return
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning(
+                    f"Failed to download bytes {part.start}-{part.end} of "
+                    f"{object_name}: {e}, resuming"
+                )
+            finally:
+                if response is not None:
+                    response.close()
+                    response.release_conn()
+
+    @staticmethod
+    def _join(download: Download) -> None:
+        file_path, size, etag = download.file_path, download.size, download.etag
+        md5 = hashlib.md5()
+        with open(file_path + ".tmp", "wb") as output:
+            for part in download.parts:
+                with open(part.path, "rb") as f:
+                    while True:
+                        data = f.read(_COPY_SIZE)
+                        if not data:
+                            break
+                        md5.update(data)
+                        output.write(data)
+            written = output.tell()
+
+        if written != size:
+            # Start over, a part has the wrong size
+            os.remove(file_path + ".tmp")
+            shutil.rmtree(file_path + ".parts")
+            raise ChecksumError(f"{file_path}: expected {size} bytes, got {written}")
+        if "-" in etag:
+            # The ETag of a multipart upload depends on its part size
+            logger.warning(
+                f"{file_path}: multipart ETag {etag}, only the size is checked"
+            )
+        elif md5.hexdigest() != etag:
+            # Start over, a part is corrupted
+            os.remove(file_path + ".tmp")
+            shutil.rmtree(file_path + ".parts")
+            raise ChecksumError(
+                f"{file_path}: expected MD5 {etag}, got {md5.hexdigest()}"
+            )
+        os.replace(file_path + ".tmp", file_path)
+        shutil.rmtree(file_path + ".parts")
+
+    def download(
+        self, objects: List[Tuple[str, str]], progress: Optional[Progress] = None
+    ) -> None:
+        """
+        Download the `(object_name, file_path)` objects concurrently.
+        """
+        if not objects:
+            return
+        downloads = []
+        for object_name, file_path in objects:
+            stat = self.client.stat_object(self.bucket_name, object_name)
+            etag = stat.etag.strip('"')
+            downloads.append(
+                Download(
+                    object_name=object_name,
+                    file_path=file_path,
+                    size=stat.size,
+                    etag=etag,
+                    parts=self._parts(file_path, stat.size, etag),
+                )
+            )
+
+        progress = progress or Progress()
+        progress.set_meta(
+            total_length=sum(download.size for download in downloads),
+            object_name=", ".join(download.object_name for download in downloads),
+        )
+        resumed = sum(
+            self._downloaded(part) for download in downloads for part in download.parts
+        )
+        if resumed:
+            progress.update(resumed)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [
+                pool.submit(self._fetch, download.object_name, part, progress)
+                for download in downloads
+                for part in download.parts
+            ]
+            for future in futures:
+                future.result()
+
+        for download in downloads:
+            self._join(download)
@@ -1,7 +1,7 @@
 import sys
 import time
 from queue import Empty, Queue
-from threading import Thread
+from threading import Lock, Thread
 
 _BAR_SIZE = 20
 _KILOBYTE = 1024
@@ -38,9 +38,11 @@ class Progress(Thread):
         self.total_length = 0
         self.interval = interval
         self.object_name = None
+        self.prefix = ""
 
         self.last_printed_len = 0
         self.current_size = 0
+        self._lock = Lock()
 
         self.display_queue = Queue()
         self.initial_time = time.time()
@@ -102,8 +104,10 @@ class Progress(Thread):
                 "Please change it to Int.".format(type(size))
             )
 
-        self.current_size += size
-        self.display_queue.put((self.current_size, self.total_length))
+        # parts of an object may be downloaded by several threads
+        with self._lock:
+            self.current_size += size
+            self.display_queue.put((self.current_size, self.total_length))
 
     def done_progress(self):
         self.total_length = 0
@@ -0,0 +1,239 @@
+import ast
+import builtins
+import os
+import threading
+from typing import Iterator, List, Optional, Set, Tuple
+
+# Calls that either stop the program before it dumps its result or could
+# modify the problem inputs, which are shared with the dataset
+FORBIDDEN_CALLS = {
+    "exit",
+    "quit",
+    "input",
+    "sys.exit",
+    "os._exit",
+    "os.kill",
+    "os.system",
+    "os.remove",
+    "os.unlink",
+    "os.rmdir",
+    "os.removedirs",
+    "shutil.rmtree",
+    "subprocess.run",
+    "subprocess.call",
+    "subprocess.check_call",
+    "subprocess.check_output",
+    "subprocess.Popen",
+}
+
+# Calls that define names at runtime, the undefined names check gives up on them
+_DYNAMIC_CALLS = {"exec", "eval", "globals", "locals", "vars"}
+
+_MODULE_NAMES = {
+    "__builtins__",
+    "__doc__",
+    "__file__",
+    "__loader__",
+    "__name__",
+    "__package__",
+    "__spec__",
+}
+
+
+class PreflightError(Exception):
+    def __init__(self, lineno: int, exc_type: str, message: str) -> None:
+        super().__init__(message)
+        self.lineno = lineno
+        self.exc_type = exc_type
+        self.message = message
+
+
+class PreflightStats:
+    """
+    Counts the programs rejected by the pre-flight checks and the test
+    executions they saved.
+    """
+
+    def __init__(self) -> None:
+        self.checked = 0
+        self.rejected = 0
+        self.launches_saved = 0
+        self._lock = threading.Lock()
+
+    def record(self, rejected: bool, launches: int) -> None:
+        with self._lock:
+            self.checked += 1
+            if rejected:
+                self.rejected += 1
+                self.launches_saved += launches
+
+    def summary(self) -> str:
+        return (
+            f"{self.rejected}/{self.checked} programs rejected, "
+            f"{self.launches_saved} executions saved"
+        )
+
+
+preflight_stats = PreflightStats()
+
+
+def _call_name(node: ast.Call) -> Optional[str]:
+    parts = []
+    func = node.func
+    while isinstance(func, ast.Attribute):
+        parts.append(func.attr)
+        func = func.value
+    if not isinstance(func, ast.Name):
+        return None
+    parts.append(func.id)
+    return ".".join(reversed(parts))
+
+
+def _bound_names(tree: ast.AST) -> Optional[Set[str]]:
+    """
+    Every name bound anywhere in the program regardless of its scope, or None
+    when names may be bound dynamically.
+    """
+    names = set(dir(builtins)) | _MODULE_NAMES
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            names.add(node.id)
+        elif isinstance(
+            node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+        ) or (isinstance(node, ast.ExceptHandler) and node.name):
+            names.add(node.name)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                if alias.name == "*":
+                    return None
+                names.add(alias.asname or alias.name.split(".")[0])
+        elif isinstance(node, ast.Call) and _call_name(node) in _DYNAMIC_CALLS:
+            return None
+        elif type(node).__name__ in ("MatchAs", "MatchStar") and node.name:
+            # `match` capture patterns
+            names.add(node.name)
+        elif type(node).__name__ == "MatchMapping" and node.rest:
+            names.add(node.rest)
+    return names
+
+
+def _evaluated_names(node: ast.AST) -> Iterator[ast.Name]:
+    """
+    The names loaded by `node` whenever it is evaluated, skipping the parts
+    that may not be evaluated (lambdas, short-circuits, ...).
+    """
+    if isinstance(node, ast.Name):
+        if isinstance(node.ctx, ast.Load):
+            yield node
+    elif isinstance(node, ast.Lambda):
+        return
+    elif isinstance(node, (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)):
+        yield from _evaluated_names(node.generators[0].iter)
+    elif isinstance(node, ast.BoolOp):
+        yield from _evaluated_names(node.values[0])
+    elif isinstance(node, ast.IfExp):
+        yield from _evaluated_names(node.test)
+    else:
+        for child in ast.iter_child_nodes(node):
+            yield from _evaluated_names(child)
+
+
+def _evaluated_parts(statement: ast.stmt) -> List[ast.AST]:
+    """
+    The parts of a module level statement that are always evaluated.
+    """
+    if isinstance(statement, (ast.Expr, ast.Assign, ast.AugAssign, ast.AnnAssign)):
+        return [statement]
+    if isinstance(statement, (ast.If, ast.While)):
+        return [statement.test]
+    if isinstance(statement, (ast.For, ast.AsyncFor)):
+        return [statement.iter]
+    if isinstance(statement, (ast.With, ast.AsyncWith)):
+        return [item.context_expr for item in statement.items]
+    # `try` may catch the NameError, definitions are not executed yet
+    return []
+
+
+def _check_undefined_names(tree: ast.Module, lines: Tuple[int, int]) -> None:
+    bound = _bound_names(tree)
+    if bound is None:
+        return
+    # the inserted code may not run all of its statements, but the context is
+    # written to run its own, e.g. dumping the `result` the inserted code defines
+    loaded = [
+        node
+        for node in ast.walk(tree)
+        if isinstance(node, ast.Name)
+        and isinstance(node.ctx, ast.Load)
+        and not lines[0] <= node.lineno <= lines[1]
+    ]
+    for statement in tree.body:
+        for part in _evaluated_parts(statement):
+            loaded.extend(_evaluated_names(part))
+    undefined = [name for name in loaded if name.id not in bound]
+    if undefined:
+        name = min(undefined, key=lambda name: (name.lineno, name.col_offset))
+        raise PreflightError(
+            name.lineno, "NameError", f"name '{name.id}' is not defined"
+        )
+
+
+def _check_forbidden_calls(tree: ast.Module, lines: Tuple[int, int]) -> None:
+    for node in ast.walk(tree):
+        if (
+            isinstance(node, ast.Call)
+            and lines[0] <= node.lineno <= lines[1]
+            and _call_name(node) in FORBIDDEN_CALLS
+        ):
+            raise PreflightError(
+                node.lineno,
+                "RuntimeError",
+                f"calling '{_call_name(node)}' is not allowed in the solution",
+            )
+
+
+def _format(program: str, error: PreflightError, filename: str) -> str:
+    program_lines = program.split("\n")
+    feedback = ["Traceback (most recent call last):"]
+    if error.exc_type == "SyntaxError":
+        feedback.append(f'  File "{filename}", line {error.lineno}')
+    else:
+        feedback.append(f'  File "{filename}", line {error.lineno}, in <module>')
+    if 0 < error.lineno <= len(program_lines):
+        feedback.append(f"    {program_lines[error.lineno - 1].strip()}")
+    feedback.append(f"{error.exc_type}: {error.message}")
+    return "\n".join(feedback) + "\n"
+
+
+def preflight(
+    code_context: str, generated_code: str, filename: str = "program.py"
+) -> Optional[str]:
+    """
+    Statically check the program assembled from `code_context` and the
+    (postprocessed) `generated_code` for errors it would surely raise.
+
+    Return a traceback-like feedback for the first error found, or None when
+    the program has to be executed.
+    """
+    program = code_context.replace("[insert]", generated_code)
+    # lines of the inserted code in the program
+    start = code_context.split("[insert]")[0].count("\n") + 1
+    lines = (start, start + generated_code.count("\n"))
+
+    try:
+        tree = ast.parse(program, filename)
+        _check_forbidden_calls(tree, lines)
+        _check_undefined_names(tree, lines)
+    except SyntaxError as e:
+        return _format(
+            program, PreflightError(e.lineno or 0, type(e).__name__, e.msg), filename
+        )
+    except PreflightError as e:
+        return _format(program, e, filename)
+    return None
+
+
+def preflight_enabled() -> bool:
+    return os.getenv("DS1000_PREFLIGHT", "1") != "0"
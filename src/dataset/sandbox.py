@@ -0,0 +1,136 @@
+import argparse
+import logging
+import os
+import shutil
+import stat
+import statistics
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Set, Union
+
+logger = logging.getLogger(__name__)
+
+# Files and directories written by the execution, never shared with the dataset
+_MATERIALIZED = {"program.py", "result"}
+
+_WRITE = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
+_protected: Set[Path] = set()
+_protected_lock = threading.Lock()
+_warned_root = False
+
+
+def copy_sandbox(problem_path: Union[str, Path], sandbox: Union[str, Path]) -> None:
+    """
+    Populate `sandbox` with a full copy of the problem directory.
+    """
+    problem_path, sandbox = Path(problem_path), Path(sandbox)
+    for file_name in os.listdir(problem_path):
+        if os.path.isfile(problem_path / file_name):
+            shutil.copy(problem_path / file_name, sandbox / file_name)
+        elif os.path.isdir(problem_path / file_name):
+            shutil.copytree(problem_path / file_name, sandbox / file_name)
+        else:
+            raise ValueError("impossible.")
+
+    # generated outputs will be put into `result`
+    if os.path.exists(sandbox / "result"):
+        shutil.rmtree(sandbox / "result")
+    os.mkdir(sandbox / "result")
+
+    # the inputs of a protected problem are copied read-only
+    for root, dirs, files in os.walk(sandbox):
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            if not os.path.islink(path):
+                os.chmod(path, os.stat(path).st_mode | stat.S_IWUSR)
+
+
+def _protect(problem_path: Path) -> None:
+    """
+    Remove the write permissions of the inputs of a problem and of their
+    directories, once per process, so that a program can neither modify,
+    rename nor delete them.
+    """
+    with _protected_lock:
+        if problem_path in _protected:
+            return
+        for root, dirs, files in os.walk(problem_path):
+            if root == str(problem_path):
+                dirs[:] = [name for name in dirs if name not in _MATERIALIZED]
+                files = [name for name in files if name not in _MATERIALIZED]
+            for name in files + dirs:
+                path = os.path.join(root, name)
+                if not os.path.islink(path):
+                    os.chmod(path, os.stat(path).st_mode & ~_WRITE)
+        os.chmod(problem_path, os.stat(problem_path).st_mode & ~_WRITE)
+        _protected.add(problem_path)
+
+
+def link_sandbox(problem_path: Union[str, Path], sandbox: Union[str, Path]) -> None:
+    """
+    Populate `sandbox` with symlinks to the inputs of the problem (`ans/`,
+    `input/`, test code, ...), only materializing `result/`.
+
+    The inputs are shared with the dataset, so they are made read-only first.
+    """
+    problem_path, sandbox = Path(problem_path).absolute(), Path(sandbox)
+    _protect(problem_path)
+    for entry in os.scandir(problem_path):
+        if entry.name not in _MATERIALIZED:
+            os.symlink(entry.path, sandbox / entry.name)
+    os.mkdir(sandbox / "result")
+
+
+def _is_root() -> bool:
+    global _warned_root
+    if os.geteuid() != 0:
+        return False
+    if not _warned_root:
+        _warned_root = True
+        logger.warning("Running as root, the inputs are copied into the sandboxes")
+    return True
+
+
+def prepare_sandbox(problem_path: Union[str, Path], sandbox: Union[str, Path]) -> None:
+    """
+    Populate `sandbox` with the inputs of a problem, by linking them unless
+    `DS1000_SANDBOX=copy`, or unless running as root, which bypasses the
+    read-only permissions of the linked inputs.
+    """
+    if os.getenv("DS1000_SANDBOX", "link") == "copy" or _is_root():
+        copy_sandbox(problem_path, sandbox)
+    else:
+        link_sandbox(problem_path, sandbox)
+
+
+def benchmark(source_dir: str, mode: str, repeat: int) -> None:
+    problems = sorted(Path(source_dir).glob(f"*/{mode}/q*"))
+    print(f"Preparing {len(problems)} sandboxes {repeat} times")
+    for prepare in [copy_sandbox, link_sandbox]:
+        durations = []
+        for _ in range(repeat):
+            for problem_path in problems:
+                with tempfile.TemporaryDirectory() as sandbox:
+                    start = time.perf_counter()
+                    prepare(problem_path, sandbox)
+                    durations.append(time.perf_counter() - start)
+        print(
+            f"{prepare.__name__}: "
+            f"mean {statistics.mean(durations) * 1000:.3f} ms, "
+            f"median {statistics.median(durations) * 1000:.3f} ms, "
+            f"max {max(durations) * 1000:.3f} ms per sandbox"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the per-test sandbox setup cost"
+    )
+    parser.add_argument("--source_dir", type=str, default="ds1000_data")
+    parser.add_argument("--mode", type=str, default="Completion")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    benchmark(args.source_dir, args.mode, args.repeat)
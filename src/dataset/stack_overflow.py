@@ -3,19 +3,19 @@ import json
 import logging
 import os
 import sys
-import xml.etree.ElementTree as ET
-from typing import List
+from typing import List, Optional, Tuple
 
 import chromadb
 import pandas as pd
-import psutil
 from chromadb.config import Settings
 from langchain_community.embeddings import AzureOpenAIEmbeddings
 from langchain_community.vectorstores import Chroma
 from langchain_core.documents.base import Document
 from minio import Minio
 
-from src.dataset.minio_helper import Progress
+from src.dataset.minio_download import RangedDownloader
+from src.dataset.stack_overflow_parser import parse_dump
+from src.dataset.stack_overflow_store import StackOverflowStore
 
 # Chroma vector store
 client = chromadb.Client(
@@ -48,160 +48,117 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def get_posts(file_name: str, tags: List[str] = [""]):
-    if not os.path.exists("stack_overflow/posts"):
-        os.makedirs("stack_overflow/posts")
-
-    posts_count = 1
-    posts_metadata = []
-
-    xmlit = iter(
-        ET.iterparse(
-            source=file_name,
-            events=("start", "end"),
-        )
-    )
-    event, _ = next(xmlit)
-    while True:
-        try:
-            event, elem = next(xmlit)
-            if event == "end" and elem.tag == "row":
-                post = elem.attrib
-                post_tags = post.get("Tags", "")
-                if any(tag in post_tags for tag in tags):
-                    posts_count += 1
-                    posts_metadata.append(
-                        {
-                            "id": post.get("Id", 1),
-                            "tags": post_tags,
-                            "created_at": post.get("CreationDate", ""),
-                        }
-                    )
-                    # Save post to file
-                    if not os.path.exists(
-                        os.path.join(
-                            "stack_overflow", "posts", post.get("Id", 1) + ".json"
-                        )
-                    ):
-                        with open(
-                            os.path.join(
-                                "stack_overflow",
-                                "posts",
-                                post.get("Id", 1) + ".json",
-                            ),
-                            "w",
-                        ) as f:
-                            json.dump(post, f, indent=4)
-
-                    if posts_count % 1000 == 0:
-                        process = psutil.Process(os.getpid())
-                        mem_info = process.memory_info()
-                        logger.info(
-                            f"Found {posts_count} posts. Current memory usage: {round(mem_info.rss / 1024 ** 2)} MB"
-                        )
-
-                # Clear the element to free up memory
-                elem.clear()
-        except ET.ParseError:
-            logger.warning("ParseError occurred, skipping to next row")
-            continue
-        except StopIteration:
-            logger.info(elem.attrib)
-            logger.info("StopIteration occurred")
-            break
-        except Exception as e:
-            logger.error(f"An unexpected error occurred: {e}")
-            break
-
-    # Save metadata to file
-    df = pd.DataFrame(posts_metadata)
-    df.to_csv("stack_overflow/posts_metadata.csv", index=False)
-
-    logger.info("Completed!")
-
-
-def get_comments(file_name: str, post_ids: set):
-    if not os.path.exists("stack_overflow/comments"):
-        os.makedirs("stack_overflow/comments")
-
-    comments_count = 1
-    comments_metadata = []
-
-    xmlit = iter(
-        ET.iterparse(
-            source=file_name,
-            events=("start", "end"),
-        )
-    )
-    event, _ = next(xmlit)
-    while True:
-        try:
-            event, elem = next(xmlit)
-            if event == "end" and elem.tag == "row":
-                comment = elem.attrib
-                if int(comment.get("PostId", 1)) in post_ids:
-                    comments_count += 1
-                    comments_metadata.append(
-                        {
-                            "id": comment.get("Id", 1),
-                            "post_id": comment.get("PostId", 1),
-                            "created_at": comment.get("CreationDate", ""),
-                        }
-                    )
-
-                    # Save comment to file
-                    if not os.path.exists(
-                        os.path.join(
-                            "stack_overflow",
-                            "comments",
-                            comment.get("Id", 1)
-                            + "_"
-                            + comment.get("PostId", 1)
-                            + ".json",
-                        )
-                    ):
-                        with open(
-                            os.path.join(
-                                "stack_overflow",
-                                "comments",
-                                comment.get("Id", 1)
-                                + "_"
-                                + comment.get("PostId", 1)
-                                + ".json",
-                            ),
-                            "w",
-                        ) as f:
-                            json.dump(comment, f, indent=4)
-
-                    if comments_count % 10000 == 0:
-                        process = psutil.Process(os.getpid())
-                        mem_info = process.memory_info()
-                        logger.info(
-                            f"Found {comments_count} comments. Current memory usage: {round(mem_info.rss / 1024 ** 2)} MB"
-                        )
-
-                # Clear the element to free up memory
-                elem.clear()
-        except ET.ParseError:
-            logger.warning("ParseError occurred, skipping to next row")
+def _is_new(row: dict, watermark: Optional[Tuple[str, int]]) -> bool:
+    return watermark is None or (
+        row.get("CreationDate", ""),
+        int(row.get("Id", 1)),
+    ) > tuple(watermark)
+
+
+def _related_post(
+    post: dict, tags: List[str], watermark: Optional[Tuple[str, int]]
+) -> Optional[dict]:
+    if any(tag in post.get("Tags", "") for tag in tags) and _is_new(post, watermark):
+        return post
+    return None
+
+
+def _related_comment(
+    comment: dict, post_ids: set, watermark: Optional[Tuple[str, int]]
+) -> Optional[dict]:
+    if int(comment.get("PostId", 1)) in post_ids and _is_new(comment, watermark):
+        return comment
+    return None
+
+
+def _write_csv(df: pd.DataFrame, path: str) -> None:
+    df.to_csv(path + ".tmp", index=False)
+    os.replace(path + ".tmp", path)
+
+
+def get_posts(
+    file_name: str,
+    store: StackOverflowStore,
+    tags: List[str] = [""],
+    workers: Optional[int] = None,
+) -> int:
+    """
+    Ingest the related posts newer than the posts watermark of the store, and
+    return their number.
+    """
+    watermark = store.watermark("posts")
+    logger.info(f"Ingesting posts newer than {watermark}")
+
+    count = 0
+    for posts in parse_dump(
+        file_name, _related_post, handler_args=(tags, watermark), workers=workers
+    ):
+        # Save posts to the store, one batch per parsed chunk
+        store.add_posts(posts)
+        count += len(posts)
+
+    logger.info(f"Completed! Found {count} new posts")
+    return count
+
+
+def get_comments(
+    file_name: str,
+    store: StackOverflowStore,
+    post_ids: set,
+    workers: Optional[int] = None,
+) -> int:
+    """
+    Ingest the comments of `post_ids` newer than the comments watermark of the
+    store, and return their number.
+    """
+    watermark = store.watermark("comments")
+    logger.info(f"Ingesting comments newer than {watermark}")
+
+    count = 0
+    for comments in parse_dump(
+        file_name,
+        _related_comment,
+        handler_args=(post_ids, watermark),
+        workers=workers,
+    ):
+        # Save comments to the store, one batch per parsed chunk
+        store.add_comments(comments)
+        count += len(comments)
+
+    logger.info(f"Completed! Found {count} new comments")
+    return count
+
+
+def _import_json_files(store: StackOverflowStore, batch_size: int = 10000) -> None:
+    """
+    Import the posts and comments saved as one JSON file each by previous
+    versions of the ingestion.
+    """
+    for table, add in [("posts", store.add_posts), ("comments", store.add_comments)]:
+        directory = os.path.join("stack_overflow", table)
+        if not os.path.isdir(directory):
             continue
-        except StopIteration:
-            logger.info(elem.attrib)
-            logger.info("StopIteration occurred")
-            break
-        except Exception as e:
-            logger.error(f"An unexpected error occurred: {e}")
-            break
-
-    # Save metadata to file
-    df = pd.DataFrame(comments_metadata)
-    df.to_csv("stack_overflow/comments_metadata.csv", index=False)
-
-    logger.info("Completed!")
+        batch = []
+        count = 0
+        for entry in os.scandir(directory):
+            if not entry.name.endswith(".json"):
+                continue
+            with open(entry.path, "r") as f:
+                batch.append(json.load(f))
+            if len(batch) == batch_size:
+                add(batch)
+                count += len(batch)
+                batch = []
+        add(batch)
+        count += len(batch)
+        logger.info(f"Imported {count} {table} from {directory}")
 
 
 class StackOverflowDataset:
     def __init__(self, download: bool = False) -> None:
+        self.store = StackOverflowStore()
+        if len(self.store) == 0 and os.path.isdir("stack_overflow/posts"):
+            _import_json_files(self.store)
         if download:
             # Download Posts and Comments from MinIO
             client = Minio(
@@ -210,36 +167,34 @@ class StackOverflowDataset:
                 secret_key=os.getenv("MINIO_SECRET_KEY"),
                 secure=False,
             )
-            if not os.path.exists("stackoverflow.com-Posts.7z") and not os.path.exists(
+            RangedDownloader(client, bucket_name="bk-imp").download(
+                [
+                    (
+                        f"self-debug/stackoverflow.com-{table}.7z",
+                        f"stackoverflow.com-{table}.7z",
+                    )
+                    for table in ["Posts", "Comments"]
+                    if not os.path.exists(f"stackoverflow.com-{table}.7z")
+                    and not os.path.exists(f"{table}.xml")
+                ]
+            )
+
+            # Parse the extracted dumps, otherwise stream them out of the archives
+            posts_file = (
                 "Posts.xml"
-            ):
-                client.fget_object(
-                    bucket_name="bk-imp",
-                    object_name="self-debug/stackoverflow.com-Posts.7z",
-                    file_path="stackoverflow.com-Posts.7z",
-                    progress=Progress(),
-                )
-            if not os.path.exists(
-                "stackoverflow.com-Comments.7z"
-            ) and not os.path.exists("Comments.xml"):
-                client.fget_object(
-                    bucket_name="bk-imp",
-                    object_name="self-debug/stackoverflow.com-Comments.7z",
-                    file_path="stackoverflow.com-Comments.7z",
-                    progress=Progress(),
-                )
-
-            # Extract Posts and Comments
-            if not os.path.exists("Posts.xml"):
-                os.system("7z x stackoverflow.com-Posts.7z")
-                os.remove("stackoverflow.com-Posts.7z")
-            if not os.path.exists("Comments.xml"):
-                os.system("7z x stackoverflow.com-Comments.7z")
-                os.remove("stackoverflow.com-Comments.7z")
+                if os.path.exists("Posts.xml")
+                else "stackoverflow.com-Posts.7z"
+            )
+            comments_file = (
+                "Comments.xml"
+                if os.path.exists("Comments.xml")
+                else "stackoverflow.com-Comments.7z"
+            )
 
             # Get all related posts
             get_posts(
-                file_name="Posts.xml",
+                file_name=posts_file,
+                store=self.store,
                 tags=[
                     "matplotlib",
                     "pandas",
@@ -252,29 +207,49 @@ class StackOverflowDataset:
                 ],
             )
 
-            # Get list of PostId
-            post_ids = set(
-                pd.read_csv("stack_overflow/posts_metadata.csv")["id"].tolist()
-            )
+            # Get list of PostId, including the posts of previous dumps
+            post_ids = self.store.post_ids()
 
             # Get all comments
-            get_comments(file_name="Comments.xml", post_ids=post_ids)
-
-        # Build index of Posts and Comments
-        if not os.path.exists("stack_overflow/index.csv"):
-            posts_metadata = pd.read_csv("stack_overflow/posts_metadata.csv")[
-                ["id", "tags"]
-            ].rename(columns={"id": "post_id"})
-            comments_metadata = pd.read_csv(
-                "stack_overflow/comments_metadata.csv"
-            ).rename(columns={"id": "comment_id"})
-            self.index = pd.merge(
-                posts_metadata, comments_metadata, on="post_id", how="inner"
-            ).sort_values(by=["post_id", "comment_id", "created_at"])
-            self.index.to_csv("stack_overflow/index.csv", index=False)
+            get_comments(file_name=comments_file, store=self.store, post_ids=post_ids)
+
+        if len(self.store) == 0:
+            raise FileNotFoundError(
+                f"No Stack Overflow posts in {self.store.path}, "
+                "ingest them with `download=True`"
+            )
+
+        # Build index of Posts and Comments from the store, so that a crashed
+        # ingestion is caught up by the next one
+        if download or not os.path.exists("stack_overflow/index.csv"):
+            self.index = self._write_metadata(self.store)
         else:
             self.index = pd.read_csv("stack_overflow/index.csv")
 
+    @staticmethod
+    def _write_metadata(store: StackOverflowStore) -> pd.DataFrame:
+        """
+        Write the metadata of the posts and comments of the store, and return
+        their index.
+        """
+        posts_metadata = pd.DataFrame(
+            store.posts_metadata(), columns=["id", "tags", "created_at"]
+        )
+        comments_metadata = pd.DataFrame(
+            store.comments_metadata(), columns=["id", "post_id", "created_at"]
+        )
+        _write_csv(posts_metadata, "stack_overflow/posts_metadata.csv")
+        _write_csv(comments_metadata, "stack_overflow/comments_metadata.csv")
+
+        index = pd.merge(
+            posts_metadata[["id", "tags"]].rename(columns={"id": "post_id"}),
+            comments_metadata.rename(columns={"id": "comment_id"}),
+            on="post_id",
+            how="inner",
+        ).sort_values(by=["post_id", "comment_id", "created_at"])
+        _write_csv(index, "stack_overflow/index.csv")
+        return index
+
     @staticmethod
     def retrieve(query: str, k: int) -> List[Document]:
         return vector_store.similarity_search(query=query, k=k)
@@ -0,0 +1,288 @@
+import logging
+import os
+import subprocess
+import time
+import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, Callable, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_ROW = b"<row"
+_BLOCK_SIZE = 1 << 20
+_RANGE_SIZE = 64 << 20
+_STREAM_CHUNK_SIZE = 16 << 20
+
+# Set in each worker process by `_init_worker`
+_handler = None
+_handler_args = ()
+
+RowHandler = Callable[..., Optional[dict]]
+
+
+def _find(f, offset: int, end: int, pattern: bytes) -> int:
+    """
+    The offset of the first `pattern` at or after `offset`, or `end`.
+    """
+    f.seek(offset)
+    tail = b""
+    position = offset
+    while position < end:
+        block = f.read(min(_BLOCK_SIZE, end - position))
+        if not block:
+            break
+        found = (tail + block).find(pattern)
+        if found != -1:
+            return position - len(tail) + found
+        # keep a partial pattern split across blocks
+        tail = block[-(len(pattern) - 1) :]
+        position += len(block)
+    return end
+
+
+def row_ranges(file_name: str, ranges: int) -> List[Tuple[int, int]]:
+    """
+    Split the rows of a Stack Exchange dump into about `ranges` byte ranges,
+    each starting on a `<row` tag. A literal `<` is always escaped inside
+    attributes, so `<row` only appears at the start of a row.
+    """
+    size = os.path.getsize(file_name)
+    with open(file_name, "rb") as f:
+        start = _find(f, 0, size, _ROW)
+        # the rows end where the closing tag of the root element starts
+        tail = max(start, size - 1024)
+        f.seek(tail)
+        closing = f.read().rfind(b"</")
+        end = tail + closing if closing != -1 else size
+        if end <= start:
+            return []
+
+        offsets = [start]
+        step = max(1, (end - start) // ranges)
+        for offset in range(start + step, end, step):
+            offset = _find(f, max(offset, offsets[-1] + 1), end, _ROW)
+            if offset >= end:
+                break
+            offsets.append(offset)
+    offsets.append(end)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def _read_range(file_name: str, start: int, end: int) -> Iterator[bytes]:
+    with open(file_name, "rb") as f:
+        f.seek(start)
+        position = start
+        while position < end:
+            block = f.read(min(_BLOCK_SIZE, end - position))
+            if not block:
+                return
+            position += len(block)
+            yield block
+
+
+def _handle(attrib: dict, selected: List[dict]) -> None:
+    row = _handler(attrib, *_handler_args)
+    if row is not None:
+        selected.append(row)
+
+
+def parse_blocks(blocks: Iterable[bytes]) -> Tuple[int, List[dict]]:
+    """
+    Parse the `<row>` elements in `blocks` with the handler of the process,
+    return the number of rows and the rows it kept.
+    """
+    parser = ET.XMLPullParser(events=("end",))
+    parser.feed(b"<rows>")
+    rows = 0
+    selected = []
+    for block in blocks:
+        parser.feed(block)
+        for _, elem in parser.read_events():
+            if elem.tag == "row":
+                rows += 1
+                _handle(elem.attrib, selected)
+                # Clear the element to free up memory
+                elem.clear()
+    return rows, selected
+
+
+def _parse_rows_one_by_one(data: bytes) -> Tuple[int, List[dict]]:
+    rows = 0
+    selected = []
+    for row in data.split(_ROW)[1:]:
+        try:
+            elem = ET.fromstring(_ROW + row.strip())
+        except ET.ParseError:
+            logger.warning("ParseError occurred, skipping to next row")
+            continue
+        rows += 1
+        _handle(elem.attrib, selected)
+    return rows, selected
+
+
+def _parse_range(file_name: str, start: int, end: int) -> Tuple[int, List[dict]]:
+    try:
+        return parse_blocks(_read_range(file_name, start, end))
+    except ET.ParseError:
+        logger.warning(
+            f"ParseError occurred in bytes {start}-{end}, parsing its rows one by one"
+        )
+        return _parse_rows_one_by_one(b"".join(_read_range(file_name, start, end)))
+
+
+def _init_worker(handler: RowHandler, handler_args: tuple) -> None:
+    global _handler, _handler_args
+    _handler = handler
+    _handler_args = handler_args
+
+
+def _collect(
+    results: Iterable[Tuple[int, List[dict]]], source: str
+) -> Iterator[List[dict]]:
+    start = time.perf_counter()
+    rows = 0
+    kept = 0
+    for range_rows, selected in results:
+        rows += range_rows
+        kept += len(selected)
+        elapsed = time.perf_counter() - start
+        logger.info(
+            f"Parsed {rows} rows of {source} ({rows / elapsed:.0f} rows/s), "
+            f"kept {kept}"
+        )
+        yield selected
+
+
+def parse_rows(
+    file_name: str,
+    handler: RowHandler,
+    handler_args: tuple = (),
+    workers: Optional[int] = None,
+) -> Iterator[List[dict]]:
+    """
+    Parse the rows of a Stack Exchange dump (`Posts.xml`, `Comments.xml`, ...)
+    in parallel, over byte ranges aligned on rows.
+
+    `handler(row, *handler_args)` is called in the worker processes on the
+    attributes of every row and returns what to keep of the row, or None.
+    The kept rows are yielded in batches, in the order of the file.
+    """
+    workers = workers or os.cpu_count() or 1
+    ranges = row_ranges(
+        file_name, max(workers * 4, os.path.getsize(file_name) // _RANGE_SIZE)
+    )
+    logger.info(f"Parsing {file_name} in {len(ranges)} ranges with {workers} workers")
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(handler, handler_args),
+    ) as pool:
+        futures = [pool.submit(_parse_range, file_name, *r) for r in ranges]
+        yield from _collect((future.result() for future in futures), file_name)
+
+
+def _parse_chunk(data: bytes) -> Tuple[int, List[dict]]:
+    try:
+        return parse_blocks([data])
+    except ET.ParseError:
+        logger.warning("ParseError occurred in a chunk, parsing its rows one by one")
+        return _parse_rows_one_by_one(data)
+
+
+def _chunks(stream: BinaryIO, chunk_size: int) -> Iterator[bytes]:
+    """
+    Split the rows read from `stream` into chunks of about `chunk_size` bytes
+    starting on a `<row` tag, without the root element.
+    """
+    pending = b""
+    started = False
+    while True:
+        block = stream.read(chunk_size)
+        if not block:
+            break
+        pending += block
+        if not started:
+            first = pending.find(_ROW)
+            if first == -1:
+                continue
+            pending = pending[first:]
+            started = True
+        # cut before the last row, which may not be complete yet
+        cut = pending.rfind(_ROW)
+        if cut > 0:
+            yield pending[:cut]
+            pending = pending[cut:]
+    if started:
+        # the rows end where the closing tag of the root element starts
+        closing = pending.rfind(b"</")
+        yield pending[:closing] if closing != -1 else pending
+
+
+def parse_stream(
+    stream: BinaryIO,
+    handler: RowHandler,
+    handler_args: tuple = (),
+    workers: Optional[int] = None,
+    source: str = "stream",
+) -> Iterator[List[dict]]:
+    """
+    Like `parse_rows`, but read the dump sequentially from `stream`, e.g. the
+    output of a decompressor, and parse its chunks in parallel as they come.
+    """
+    workers = workers or os.cpu_count() or 1
+    logger.info(f"Parsing {source} with {workers} workers")
+
+    def results(pool: ProcessPoolExecutor) -> Iterator[Tuple[int, List[dict]]]:
+        # bound the chunks in memory while the workers catch up
+        futures = deque()
+        for chunk in _chunks(stream, _STREAM_CHUNK_SIZE):
+            futures.append(pool.submit(_parse_chunk, chunk))
+            if len(futures) >= workers * 2:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(handler, handler_args),
+    ) as pool:
+        yield from _collect(results(pool), source)
+
+
+def parse_archive(
+    archive: str,
+    handler: RowHandler,
+    handler_args: tuple = (),
+    workers: Optional[int] = None,
+) -> Iterator[List[dict]]:
+    """
+    Parse the dump in a 7z `archive` as 7z decompresses it, the XML is never
+    written to disk.
+    """
+    process = subprocess.Popen(["7z", "x", "-so", archive], stdout=subprocess.PIPE)
+    try:
+        yield from parse_stream(
+            process.stdout, handler, handler_args, workers, source=archive
+        )
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise RuntimeError(f"7z failed to decompress {archive} ({returncode})")
+
+
+def parse_dump(
+    file_name: str,
+    handler: RowHandler,
+    handler_args: tuple = (),
+    workers: Optional[int] = None,
+) -> Iterator[List[dict]]:
+    """
+    Parse an extracted `.xml` dump over byte ranges, or stream a `.7z` one.
+    """
+    if file_name.endswith(".7z"):
+        return parse_archive(file_name, handler, handler_args, workers)
+    return parse_rows(file_name, handler, handler_args, workers)
@@ -0,0 +1,184 @@
+import json
+import os
+import sqlite3
+import threading
+from typing import List, Optional, Set, Tuple
+
+STORE_PATH = os.path.join("stack_overflow", "store.sqlite")
+
+
+class StackOverflowStore:
+    """
+    The Stack Overflow posts and their comments in a single SQLite file.
+
+    Rows keep every attribute of the dump. Comments are indexed by post, so a
+    post and its ordered comments are read in one lookup.
+
+    The store keeps the high-water mark (CreationDate, Id) of each table, so
+    that a newer dump is ingested incrementally, and the posts whose comments
+    changed since they were last rendered.
+    """
+
+    def __init__(self, path: str = STORE_PATH) -> None:
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS posts ("
+                "id INTEGER PRIMARY KEY, tags TEXT NOT NULL, "
+                "created_at TEXT NOT NULL, data TEXT NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS comments ("
+                "id INTEGER PRIMARY KEY, post_id INTEGER NOT NULL, "
+                "created_at TEXT NOT NULL, data TEXT NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS comments_post_id ON comments (post_id, id)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS watermarks ("
+                "name TEXT PRIMARY KEY, created_at TEXT NOT NULL, id INTEGER NOT NULL)"
+            )
+            backfill = (
+                self._conn.execute(
+                    "SELECT 1 FROM sqlite_master "
+                    "WHERE type = 'table' AND name = 'changed_posts'"
+                ).fetchone()
+                is None
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS changed_posts (post_id INTEGER PRIMARY KEY)"
+            )
+            if backfill:
+                # Stores ingested before the changes were tracked are rendered
+                # in full once
+                self._conn.execute("INSERT INTO changed_posts SELECT id FROM posts")
+
+    def watermark(self, table: str) -> Optional[Tuple[str, int]]:
+        """
+        The (CreationDate, Id) of the newest row ingested into `table`.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT created_at, id FROM watermarks WHERE name = ?", (table,)
+            ).fetchone()
+        return tuple(row) if row else None
+
+    def _advance_watermark(self, table: str, rows: List[dict]) -> None:
+        if not rows:
+            return
+        newest = max(
+            (row.get("CreationDate", ""), int(row.get("Id", 1))) for row in rows
+        )
+        current = self._conn.execute(
+            "SELECT created_at, id FROM watermarks WHERE name = ?", (table,)
+        ).fetchone()
+        if current is None or newest > tuple(current):
+            self._conn.execute(
+                "INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?)", (table, *newest)
+            )
+
+    def add_posts(self, posts: List[dict]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO posts VALUES (?, ?, ?, ?)",
+                [
+                    (
+                        int(post.get("Id", 1)),
+                        post.get("Tags", ""),
+                        post.get("CreationDate", ""),
+                        json.dumps(post),
+                    )
+                    for post in posts
+                ],
+            )
+            self._advance_watermark("posts", posts)
+
+    def add_comments(self, comments: List[dict]) -> None:
+        with self._lock, self._conn:
+            changed = set()
+            for comment in comments:
+                post_id = int(comment.get("PostId", 1))
+                inserted = self._conn.execute(
+                    "INSERT OR IGNORE INTO comments VALUES (?, ?, ?, ?)",
+                    (
+                        int(comment.get("Id", 1)),
+                        post_id,
+                        comment.get("CreationDate", ""),
+                        json.dumps(comment),
+                    ),
+                ).rowcount
+                if inserted:
+                    changed.add(post_id)
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO changed_posts VALUES (?)",
+                [(post_id,) for post_id in changed],
+            )
+            self._advance_watermark("comments", comments)
+
+    def get(self, post_id: int) -> Optional[Tuple[dict, List[dict]]]:
+        """
+        Return a post and its comments ordered by id, or None when the post is
+        not in the store.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT posts.data, comments.data FROM posts "
+                "LEFT JOIN comments ON comments.post_id = posts.id "
+                "WHERE posts.id = ? ORDER BY comments.id",
+                (int(post_id),),
+            ).fetchall()
+        if not rows:
+            return None
+        post = json.loads(rows[0][0])
+        comments = [json.loads(comment) for _, comment in rows if comment is not None]
+        return post, comments
+
+    def post_ids(self) -> Set[int]:
+        with self._lock:
+            return {post_id for post_id, in self._conn.execute("SELECT id FROM posts")}
+
+    def posts_metadata(self) -> List[Tuple[int, str, str]]:
+        """
+        The (id, tags, created_at) of every post, ordered by id.
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, tags, created_at FROM posts ORDER BY id"
+            ).fetchall()
+
+    def comments_metadata(self) -> List[Tuple[int, int, str]]:
+        """
+        The (id, post_id, created_at) of every comment, ordered by id.
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, post_id, created_at FROM comments ORDER BY id"
+            ).fetchall()
+
+    def changed_posts(self) -> List[int]:
+        """
+        The posts with new comments since they were last marked as rendered.
+        """
+        with self._lock:
+            return [
+                post_id
+                for post_id, in self._conn.execute(
+                    "SELECT post_id FROM changed_posts ORDER BY post_id"
+                )
+            ]
+
+    def mark_rendered(self, post_ids: List[int]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "DELETE FROM changed_posts WHERE post_id = ?",
+                [(int(post_id),) for post_id in post_ids],
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
@@ -0,0 +1,94 @@
+import math
+import os
+import threading
+from typing import List
+
+from src.cache import CACHE_DIR, PersistentCache
+
+OFFICIAL_TIME_LIMIT = 60  # should not change the official time_limit
+
+
+def percentile(values: List[float], q: float) -> float:
+    # nearest-rank percentile
+    values = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(values)))
+    return values[rank - 1]
+
+
+class RuntimeHistory:
+    """
+    The durations of the last `max_samples` passing runs of each test case,
+    persisted across runs.
+    """
+
+    def __init__(self, path: str, max_samples: int = 20) -> None:
+        self.cache = PersistentCache(path)
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+
+    def durations(self, key: str) -> List[float]:
+        return self.cache.get(key) or []
+
+    def record(self, key: str, duration: float) -> None:
+        with self._lock:
+            durations = self.durations(key) + [duration]
+            self.cache.set(key, durations[-self.max_samples :])
+
+
+class TimeoutPolicy:
+    """
+    Derives the time limit of a test case from the durations of its passing
+    runs: `factor` x p99, at least `floor` and at most the official limit.
+
+    Test cases without history, and every test case when `adaptive` is False,
+    get the official limit.
+    """
+
+    def __init__(
+        self,
+        history: RuntimeHistory,
+        adaptive: bool = True,
+        factor: float = 5.0,
+        floor: float = 5.0,
+        limit: float = OFFICIAL_TIME_LIMIT,
+    ) -> None:
+        self.history = history
+        self.adaptive = adaptive
+        self.factor = factor
+        self.floor = floor
+        self.limit = limit
+
+    def timeout(self, key: str) -> float:
+        if not self.adaptive:
+            return self.limit
+        durations = self.history.durations(key)
+        if not durations:
+            return self.limit
+        return min(self.limit, max(self.floor, self.factor * percentile(durations, 99)))
+
+    def record(self, key: str, duration: float) -> None:
+        self.history.record(key, duration)
+
+
+_timeout_policy = None
+_timeout_policy_lock = threading.Lock()
+
+
+def get_timeout_policy() -> TimeoutPolicy:
+    """
+    Return the process-wide timeout policy.
+
+    `DS1000_TIMEOUT=official` keeps the official limit for every test case,
+    e.g. for final scoring runs. The adaptive limits are tuned with
+    `DS1000_TIMEOUT_FACTOR` and `DS1000_TIMEOUT_FLOOR` (seconds).
+    """
+    global _timeout_policy
+    with _timeout_policy_lock:
+        if _timeout_policy is None:
+            _timeout_policy = TimeoutPolicy(
+                history=RuntimeHistory(os.path.join(CACHE_DIR, "runtimes.sqlite")),
+                adaptive=os.getenv("DS1000_TIMEOUT", "adaptive") != "official",
+                factor=float(os.getenv("DS1000_TIMEOUT_FACTOR") or 5.0),
+                floor=float(os.getenv("DS1000_TIMEOUT_FLOOR") or 5.0),
+            )
+        return _timeout_policy
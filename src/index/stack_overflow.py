@@ -4,14 +4,12 @@ load_dotenv(".env")
 
 
 import glob
-import json
 import logging
 import os
 import sys
 from typing import List
 
 import chromadb
-import pandas as pd
 import tiktoken as tk
 from chromadb.config import Settings
 from langchain.schema.document import Document
@@ -20,6 +18,7 @@ from langchain_community.vectorstores import Chroma
 from tqdm.auto import tqdm
 
 from src.dataset import Dataset
+from src.dataset.stack_overflow_store import StackOverflowStore
 from src.utils import hashes
 
 # Tiktoken encoding
@@ -51,7 +50,11 @@ logger = logging.getLogger(__name__)
 
 
 def retrieve(
-    index: pd.DataFrame, post_id: int, max_token: int, min_comments: int, step: int
+    store: StackOverflowStore,
+    post_id: int,
+    max_token: int,
+    min_comments: int,
+    step: int,
 ) -> List[str]:
     post_template = """
     Post: {post}
@@ -60,22 +63,12 @@ def retrieve(
     """
 
     # Retrieve the post and comments
-    post = json.load(
-        open(os.path.join("stack_overflow", "posts", str(post_id) + ".json"), "r")
-    ).get("Body", "")
-    comments = []
-    for comment_id in index[index["post_id"] == post_id]["comment_id"]:
-        comment = json.load(
-            open(
-                os.path.join(
-                    "stack_overflow",
-                    "comments",
-                    str(comment_id) + "_" + str(post_id) + ".json",
-                ),
-                "r",
-            )
-        ).get("Text", "")
-        comments.append(comment)
+    entry = store.get(post_id)
+    if entry is None:
+        return [""]
+    post, comments = entry
+    post = post.get("Body", "")
+    comments = [comment.get("Text", "") for comment in comments]
     if len(comments) < min_comments:
         return [""]
 
@@ -147,32 +140,45 @@ if __name__ == "__main__":
         dataset="stack_overflow", kwargs={"download": False}
     ).dataset
 
-    # Generate a list of rendered posts
+    # Render the posts whose comments changed since they were last rendered
     if not os.path.exists("stack_overflow/rendered_posts"):
         os.makedirs("stack_overflow/rendered_posts")
 
-    post_ids = stack_overflow_dataset.index["post_id"].unique()
+    store = stack_overflow_dataset.store
+    post_ids = store.changed_posts()
+    rendered_posts = []
     for post_id in tqdm(post_ids, total=len(post_ids)):
-        rendered_posts = retrieve(
-            index=stack_overflow_dataset.index,
+        rendered = retrieve(
+            store=store,
             post_id=post_id,
             max_token=3000,
             min_comments=10,
             step=5,
         )
-        if rendered_posts[0] != "":
-            for i, rendered_post in enumerate(rendered_posts):
-                with open(
-                    os.path.join(
-                        "stack_overflow", "rendered_posts", f"{post_id}_{i}.txt"
-                    ),
-                    "w",
-                ) as f:
-                    f.write(rendered_post)
+        rendered = [] if rendered[0] == "" else rendered
+
+        # Remove the outdated renders from the vector store before their files,
+        # so that a crash leaves them to be removed by the next run
+        stale_paths = glob.glob(f"stack_overflow/rendered_posts/{post_id}_*.txt")
+        stale_ids = set()
+        for path in stale_paths:
+            with open(path, "r") as f:
+                stale_ids.add(hashes(f.read()))
+        stale_ids -= {hashes(rendered_post) for rendered_post in rendered}
+        if stale_ids:
+            vector_store.delete(ids=list(stale_ids))
+        for path in stale_paths:
+            os.remove(path)
+
+        for i, rendered_post in enumerate(rendered):
+            path = os.path.join(
+                "stack_overflow", "rendered_posts", f"{post_id}_{i}.txt"
+            )
+            with open(path, "w") as f:
+                f.write(rendered_post)
+            rendered_posts.append(path)
 
     # Ingest into the vector store
-    rendered_posts = glob.glob("stack_overflow/rendered_posts/*.txt")
-
     chunk_size = 20
     for i in tqdm(range(0, len(rendered_posts), chunk_size)):
         chunk = rendered_posts[i : i + chunk_size]
@@ -181,3 +187,5 @@ if __name__ == "__main__":
             with open(post, "r") as f:
                 docs.append(Document(page_content=f.read()))
         ingest_vector_store(docs=docs, vector_store=vector_store)
+
+    store.mark_rendered(post_ids)
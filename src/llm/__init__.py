@@ -1,19 +1,157 @@
+import json
 import os
+import random
+import threading
+import time
+from typing import Optional
 
+import openai
+import tiktoken as tk
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import LLMResult
+from langchain_core.prompt_values import PromptValue
 from langchain_openai import AzureChatOpenAI
 
+from src.cache import CACHE_DIR, PersistentCache
+from src.llm.rate_limiter import get_rate_limiter
+from src.utils import hashes
+
+# Tiktoken encoding
+encoding = tk.encoding_for_model("gpt-3.5-turbo-0613")
+
+# Completion tokens charged up front, settled once the usage is known
+_COMPLETION_TOKENS_ESTIMATE = 512
+
+LLM_CACHE_PATH = os.path.join(CACHE_DIR, "llm.sqlite")
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> PersistentCache:
+    """
+    Return the process-wide cache of LLM responses.
+    """
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = PersistentCache(LLM_CACHE_PATH)
+        return _response_cache
+
+
+def _retry_after(e: openai.APIStatusError) -> Optional[float]:
+    headers = e.response.headers
+    if headers.get("retry-after-ms"):
+        return float(headers["retry-after-ms"]) / 1000
+    if headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            return None
+    return None
+
+
+def _used_tokens(prompt_tokens: int, result: LLMResult) -> int:
+    """
+    The tokens used by a completion, as reported by the API, or counted from
+    the completion when the usage is missing.
+    """
+    generation = result.generations[0][0]
+    for usage in [
+        (result.llm_output or {}).get("token_usage"),
+        (generation.generation_info or {}).get("token_usage"),
+    ]:
+        if usage and usage.get("total_tokens") is not None:
+            return usage["total_tokens"]
+    return prompt_tokens + len(encoding.encode(generation.text))
+
 
 class LLM:
     def __init__(self, model: str, config: dict):
+        self.model = model
+        self.temperature = config.get("temperature", 0.5)
         if model == "gpt35-turbo":
+            self.deployment = "gpt-35"
             self.llm = AzureChatOpenAI(
                 openai_api_key=os.getenv("AZURE_OPENAI_API_KEY"),
                 openai_api_version=os.getenv("OPENAI_API_VERSION"),
                 azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-                deployment_name="gpt-35",
-                temperature=config.get("temperature", 0.5),
-                max_retries=config.get("max_retries", 3),
+                deployment_name=self.deployment,
+                temperature=self.temperature,
+                # Retries are handled by `invoke` so 429s reach the rate limiter
+                max_retries=0,
                 verbose=config.get("verbose", False),
             )
         else:
             raise ValueError(f"Unknown model: {model}")
+
+        self.max_retries = config.get("max_retries", 3)
+        self.rate_limiter = get_rate_limiter(self.deployment)
+
+        # Only deterministic calls can be replayed from the cache
+        self.cache = (
+            get_response_cache()
+            if config.get("cache", True) and self.temperature == 0
+            else None
+        )
+
+    def cache_key(self, prompt: PromptValue) -> str:
+        return hashes(
+            json.dumps(
+                {
+                    "model": self.model,
+                    "deployment": self.deployment,
+                    "messages": [
+                        [message.type, message.content]
+                        for message in prompt.to_messages()
+                    ],
+                    "temperature": self.temperature,
+                },
+                sort_keys=True,
+            )
+        )
+
+    def invoke(self, prompt: PromptValue) -> BaseMessage:
+        """
+        Invoke the LLM, replaying the response from the cache when possible.
+        """
+        if self.cache is None:
+            return self._invoke(prompt)
+
+        key = self.cache_key(prompt)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return AIMessage(content=cached["content"])
+
+        answer = self._invoke(prompt)
+        self.cache.set(key, {"content": answer.content})
+        return answer
+
+    def _invoke(self, prompt: PromptValue) -> BaseMessage:
+        """
+        Invoke the LLM through the process-wide rate limiter of the deployment.
+        """
+        prompt_tokens = len(encoding.encode(prompt.to_string()))
+        tokens = prompt_tokens + _COMPLETION_TOKENS_ESTIMATE
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire(tokens)
+            try:
+                # `generate` keeps the usage, `invoke` drops it in langchain-openai 0.0.6
+                result = self.llm.generate([prompt.to_messages()])
+            except openai.RateLimitError as e:
+                self.rate_limiter.on_rate_limited(_retry_after(e))
+                if attempt == self.max_retries:
+                    raise
+                continue
+            except (
+                openai.APIConnectionError,
+                openai.InternalServerError,
+            ):
+                if attempt == self.max_retries:
+                    raise
+                # Exponential backoff with jitter
+                time.sleep(min(2**attempt, 60) * random.uniform(0.5, 1.5))
+                continue
+
+            self.rate_limiter.on_success(tokens, _used_tokens(prompt_tokens, result))
+            return result.generations[0][0].message
@@ -0,0 +1,142 @@
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+# Azure enforces the per-minute quota over 10 second windows, so a bucket
+# never holds more than a sixth of the quota
+_BURST_FRACTION = 1 / 6
+_INCREASE_AFTER = 20  # consecutive successes before raising the rate
+_INCREASE_FACTOR = 1.1
+_DECREASE_FACTOR = 0.5
+_MIN_FRACTION = 0.05  # never go below 5% of the quota
+_DEFAULT_RETRY_AFTER = 10.0
+
+
+class _Bucket:
+    def __init__(self, rate_per_minute: float) -> None:
+        self.rate = rate_per_minute
+        self.level = self.capacity
+        self.updated_at = time.monotonic()
+
+    @property
+    def capacity(self) -> float:
+        return max(self.rate * _BURST_FRACTION, 1.0)
+
+    def refill(self, now: float) -> None:
+        self.level = min(
+            self.capacity, self.level + (now - self.updated_at) * self.rate / 60
+        )
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        # Requests larger than the bucket only wait for a full bucket
+        missing = min(amount, self.capacity) - self.level
+        return max(missing * 60 / self.rate, 0.0)
+
+
+class RateLimiter:
+    """
+    Token bucket limiter over both requests/minute and tokens/minute.
+
+    The limiter starts at `initial_fraction` of the deployment quota, raises
+    the rate after a streak of successful calls and halves it on every 429,
+    pausing all callers for the Retry-After period returned by the server.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float,
+        tokens_per_minute: float,
+        initial_fraction: float = 0.5,
+    ) -> None:
+        self.max_requests_per_minute = requests_per_minute
+        self.max_tokens_per_minute = tokens_per_minute
+
+        self._lock = threading.Lock()
+        self._requests = _Bucket(requests_per_minute * initial_fraction)
+        self._tokens = _Bucket(tokens_per_minute * initial_fraction)
+        self._blocked_until = 0.0
+        self._successes = 0
+
+        self.throttled = 0
+
+    @property
+    def requests_per_minute(self) -> float:
+        return self._requests.rate
+
+    @property
+    def tokens_per_minute(self) -> float:
+        return self._tokens.rate
+
+    def acquire(self, tokens: int) -> None:
+        """
+        Block until a request consuming `tokens` tokens can be sent.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._requests.refill(now)
+                self._tokens.refill(now)
+                wait = max(
+                    self._blocked_until - now,
+                    self._requests.wait_time(1),
+                    self._tokens.wait_time(tokens),
+                )
+                if wait <= 0:
+                    self._requests.level -= 1
+                    self._tokens.level -= tokens
+                    return
+            time.sleep(wait)
+
+    def on_success(self, estimated_tokens: int, used_tokens: Optional[int]) -> None:
+        with self._lock:
+            # Settle the difference between the estimate and the actual usage
+            if used_tokens is not None:
+                self._tokens.level -= used_tokens - estimated_tokens
+
+            self._successes += 1
+            if self._successes >= _INCREASE_AFTER:
+                self._successes = 0
+                self._scale(_INCREASE_FACTOR)
+
+    def on_rate_limited(self, retry_after: Optional[float]) -> None:
+        with self._lock:
+            self.throttled += 1
+            self._successes = 0
+            self._scale(_DECREASE_FACTOR)
+
+            # Pause every caller, not only the one that got throttled
+            if retry_after is None:
+                retry_after = _DEFAULT_RETRY_AFTER
+            self._blocked_until = max(
+                self._blocked_until, time.monotonic() + retry_after
+            )
+
+    def _scale(self, factor: float) -> None:
+        for bucket, quota in [
+            (self._requests, self.max_requests_per_minute),
+            (self._tokens, self.max_tokens_per_minute),
+        ]:
+            bucket.refill(time.monotonic())
+            bucket.rate = min(max(bucket.rate * factor, quota * _MIN_FRACTION), quota)
+            bucket.level = min(bucket.level, bucket.capacity)
+
+
+_rate_limiters: Dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(deployment: str) -> RateLimiter:
+    """
+    Return the process-wide limiter of a deployment.
+
+    The quota is read from `LLM_REQUESTS_PER_MINUTE` and `LLM_TOKENS_PER_MINUTE`.
+    """
+    with _rate_limiters_lock:
+        if deployment not in _rate_limiters:
+            _rate_limiters[deployment] = RateLimiter(
+                requests_per_minute=float(os.getenv("LLM_REQUESTS_PER_MINUTE") or 1440),
+                tokens_per_minute=float(os.getenv("LLM_TOKENS_PER_MINUTE") or 240000),
+            )
+        return _rate_limiters[deployment]
@@ -0,0 +1,284 @@
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from queue import PriorityQueue, Queue
+from typing import List, NamedTuple, Optional, Tuple
+
+from tqdm.auto import tqdm
+
+from src.code_generator import CodeGenerator
+from src.dataset.ds1000 import DS1000Dataset
+from src.dataset.stack_overflow import StackOverflowDataset
+from src.dataset.timeouts import get_timeout_policy
+
+_STOP = None
+
+
+class Job(NamedTuple):
+    lib: str
+    index: int
+    attempt: int  # 0 is the initial generation, then self-correction attempts
+    feedback: Optional[tuple]
+
+
+class StageStats:
+    def __init__(self, name: str, workers: int) -> None:
+        self.name = name
+        self.workers = workers
+        self.jobs = 0
+        self.busy_time = 0.0
+        self.depths: List[int] = []
+        self._lock = threading.Lock()
+
+    def record(self, duration: float) -> None:
+        with self._lock:
+            self.jobs += 1
+            self.busy_time += duration
+
+    def summary(self, elapsed: float) -> str:
+        utilization = self.busy_time / (self.workers * elapsed) if elapsed else 0.0
+        mean_depth = sum(self.depths) / len(self.depths) if self.depths else 0.0
+        max_depth = max(self.depths, default=0)
+        return (
+            f"{self.name}: {self.jobs} jobs, {self.workers} workers, "
+            f"{utilization * 100:.2f}% utilization, "
+            f"queue depth mean {mean_depth:.2f} / max {max_depth}"
+        )
+
+
+class ProblemScheduler:
+    """
+    Solves DS-1000 problems with a generate -> test pipeline.
+
+    Generation workers pull jobs from a priority queue and push the generated
+    code into a bounded queue consumed by the test workers, so LLM round-trips
+    overlap with test executions. A failed test feeds a self-correction job
+    back into the generation queue; correction jobs are served before new
+    problems so that problems in flight finish first.
+    """
+
+    def __init__(
+        self,
+        problem_dataset: DS1000Dataset,
+        stack_overflow: Optional[StackOverflowDataset],
+        strategy: str,
+        output_dir: str,
+        max_concurrency: int = 8,
+        max_attempts: int = 5,
+        correction_strategy: str = "zero-shot",
+        test_workers: int = 4,
+        test_queue_size: int = 16,
+    ) -> None:
+        self.problem_dataset = problem_dataset
+        self.stack_overflow = stack_overflow
+        self.strategy = strategy
+        self.output_dir = os.path.abspath(output_dir)
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.test_workers = test_workers
+        self.test_queue_size = test_queue_size
+
+        self.initial_generator = CodeGenerator(model="gpt35-turbo", strategy="cot")
+        self.correcting_generator = CodeGenerator(
+            model="gpt35-turbo", strategy=correction_strategy
+        )
+
+        # Create directories
+        for stage in ["initial", "correcting"]:
+            os.makedirs(os.path.join(self.output_dir, stage, strategy), exist_ok=True)
+
+    def _artifact(self, stage: str, lib: str, i: int, ext: str) -> str:
+        return os.path.join(
+            self.output_dir, stage, self.strategy, f"{lib}_{str(i).zfill(3)}.{ext}"
+        )
+
+    def _write(self, path: str, content: str) -> None:
+        with open(path, "w") as f:
+            f.write(content)
+
+    def pending(self, libraries: List[str]) -> List[Tuple[str, int]]:
+        # Skip solved problems
+        return [
+            (lib, i)
+            for lib in libraries
+            for i in range(len(self.problem_dataset[lib]))
+            if not os.path.exists(self._artifact("correcting", lib, i, "txt"))
+        ]
+
+    def precompute_cot(self, libraries: List[str]) -> None:
+        """
+        Generate the CoT suggestions of every pending problem up front.
+        """
+        self.initial_generator.cot.precompute(
+            problems=[
+                self.problem_dataset[lib][i]["prompt"]
+                for lib, i in self.pending(libraries)
+            ],
+            stack_overflow=self.stack_overflow,
+            max_workers=self.max_concurrency,
+        )
+
+    def calibrate_timeouts(self, libraries: List[str]) -> None:
+        """
+        Run the reference solutions of every pending problem under the official
+        time limit, so that their durations seed the adaptive time limits.
+        """
+        if not get_timeout_policy().adaptive:
+            return
+        pending = self.pending(libraries)
+        challenges = [self.problem_dataset[lib][i] for lib, i in pending]
+        with ThreadPoolExecutor(max_workers=self.test_workers) as pool:
+            futures = {
+                pool.submit(
+                    challenge.test,
+                    challenge["reference_code"],
+                    official_time_limit=True,
+                ): (lib, i)
+                for challenge, (lib, i) in zip(challenges, pending)
+            }
+            for future in tqdm(
+                as_completed(futures), total=len(futures), desc="Calibrating timeouts"
+            ):
+                try:
+                    future.result()
+                except Exception as e:
+                    # Without runtimes, the problem keeps the official time limit
+                    lib, i = futures[future]
+                    tqdm.write(f"Failed to calibrate {lib}_{i:03d}: {e}")
+        for challenge in challenges:
+            challenge.release_answers()
+
+    def generate(self, job: Job) -> str:
+        challenge = self.problem_dataset[job.lib][job.index]
+        if job.attempt == 0:
+            generated_code = self.initial_generator.generate(
+                problem=challenge["prompt"],
+                code_context=challenge["code_context"],
+                stack_overflow=self.stack_overflow,
+                feedback=None,
+            )
+            self._write(
+                self._artifact("initial", job.lib, job.index, "py"), generated_code
+            )
+        else:
+            generated_code = self.correcting_generator.generate(
+                problem=challenge["prompt"],
+                code_context=challenge["code_context"],
+                stack_overflow=self.stack_overflow,
+                feedback=job.feedback,
+            )
+            self._write(
+                self._artifact("correcting", job.lib, job.index, "py"), generated_code
+            )
+        return generated_code
+
+    def finish(self, job: Job, solved: bool) -> None:
+        self.problem_dataset[job.lib][job.index].release_answers()
+        self._write(
+            self._artifact("correcting", job.lib, job.index, "txt"),
+            "Correct" if solved else "Incorrect",
+        )
+
+    def run(self, libraries: List[str]) -> None:
+        jobs = self.pending(libraries)
+        if not jobs:
+            return
+
+        generation_queue = PriorityQueue()
+        test_queue = Queue(maxsize=self.test_queue_size)
+        generation_stats = StageStats("Generation", self.max_concurrency)
+        test_stats = StageStats("Test", self.test_workers)
+
+        order = itertools.count()
+        remaining = [len(jobs)]
+        remaining_lock = threading.Lock()
+        done = threading.Event()
+        progress = tqdm(total=len(jobs), desc="Solving problems")
+
+        def submit(job: Job) -> None:
+            # Serve the most advanced problems first
+            generation_queue.put((-job.attempt, next(order), job))
+
+        def close(job: Job, solved: Optional[bool]) -> None:
+            # Problems that failed with an error are left to the next run
+            if solved is not None:
+                self.finish(job, solved)
+            progress.update(1)
+            with remaining_lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    done.set()
+
+        def generation_worker() -> None:
+            while True:
+                _, _, job = generation_queue.get()
+                if job is _STOP:
+                    return
+                start = time.perf_counter()
+                try:
+                    generated_code = self.generate(job)
+                except Exception as e:
+                    # Surface errors of a problem without stopping the others
+                    tqdm.write(f"Failed to generate {job.lib}_{job.index:03d}: {e}")
+                    close(job, None)
+                    continue
+                finally:
+                    generation_stats.record(time.perf_counter() - start)
+                test_queue.put((job, generated_code))
+
+        def test_worker() -> None:
+            while True:
+                item = test_queue.get()
+                if item is _STOP:
+                    return
+                job, generated_code = item
+                challenge = self.problem_dataset[job.lib][job.index]
+                start = time.perf_counter()
+                try:
+                    is_correct = challenge.test(generated_code)
+                except Exception as e:
+                    tqdm.write(f"Failed to test {job.lib}_{job.index:03d}: {e}")
+                    close(job, None)
+                    continue
+                finally:
+                    test_stats.record(time.perf_counter() - start)
+
+                if isinstance(is_correct, tuple) and job.attempt < self.max_attempts:
+                    # Handle self-correction
+                    submit(job._replace(attempt=job.attempt + 1, feedback=is_correct))
+                else:
+                    close(job, isinstance(is_correct, bool) and (is_correct == True))
+
+        for lib, i in jobs:
+            submit(Job(lib=lib, index=i, attempt=0, feedback=None))
+
+        start = time.perf_counter()
+        threads = [
+            threading.Thread(target=generation_worker, daemon=True)
+            for _ in range(self.max_concurrency)
+        ] + [
+            threading.Thread(target=test_worker, daemon=True)
+            for _ in range(self.test_workers)
+        ]
+        for thread in threads:
+            thread.start()
+
+        # Sample the queue depths while the pipeline is running
+        while not done.wait(timeout=1):
+            generation_stats.depths.append(generation_queue.qsize())
+            test_stats.depths.append(test_queue.qsize())
+        elapsed = time.perf_counter() - start
+
+        for _ in range(self.max_concurrency):
+            generation_queue.put((0, next(order), _STOP))
+        for _ in range(self.test_workers):
+            test_queue.put(_STOP)
+        for thread in threads:
+            thread.join()
+        progress.close()
+
+        print(f"Pipeline finished in {elapsed:.2f}s")
+        for stats in [generation_stats, test_stats]:
+            print(stats.summary(elapsed))
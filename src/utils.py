@@ -1,14 +1,19 @@
+import fcntl
 import json
 import os
 import platform
 import shutil
 import subprocess
 import tarfile
+import tempfile
+import threading
 
 import pyzstd
 import requests
 from xxhash import xxh64
 
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
 
 def syntax_check(code: str) -> dict:
     try:
@@ -19,59 +24,122 @@ def syntax_check(code: str) -> dict:
 
 
 def _subprocess_run(command: list, cwd: str = None) -> None:
-    process = subprocess.Popen(
+    process = subprocess.run(
         command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd
     )
-    _, stderr = process.communicate()
-    print(stderr.decode())
-
-
-def setup_test_env():
-    if platform.system() != "Linux":
-        raise OSError("This script only supports Linux.")
-    elif not os.path.exists(os.path.expanduser("~/.self-debug")):
-        # Download Python binary
-        url = "https://github.com/indygreg/python-build-standalone/releases/download/20210506/cpython-3.8.10-x86_64-unknown-linux-gnu-pgo-20210506T0943.tar.zst"
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-
-        destination = "python-build-standalone.tar.zst"
-        with open(destination, "wb") as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                file.write(chunk)
-
-        # Decompress .zst file
-        decompressed_file = "python-build-standalone.tar"
-        with open(destination, "rb") as f_in, open(decompressed_file, "wb") as f_out:
-            dctx = pyzstd.ZstdDecompressor()
-            f_out.write(dctx.decompress(f_in.read()))
-
-        # Open decompressed .tar file
-        if os.path.exists(os.path.expanduser("~/.self-debug")):
-            shutil.rmtree(os.path.expanduser("~/.self-debug"))
-        with tarfile.open(decompressed_file, "r") as tar:
-            tar.extractall(os.path.expanduser("~/.self-debug"))
-
-        # Clean up
-        os.remove(destination)
-        os.remove(decompressed_file)
-
-    # Set the Python interpreter path
-    python_metadata = json.load(
-        open(os.path.expanduser("~/.self-debug/python/PYTHON.json"))
-    )
-    python_interpreter = os.path.join(
-        os.path.expanduser("~/.self-debug/python"), python_metadata["python_exe"]
-    )
+    print(process.stderr.decode())
+    process.check_returncode()
 
-    # Install venv
-    _subprocess_run([python_interpreter, "-m", "venv", ".venv"])
 
-    # Install dependencies
-    _subprocess_run([".venv/bin/pip", "install", "-U", "pip"])
-    _subprocess_run([".venv/bin/pip", "install", "-U", "poetry"])
-    _subprocess_run([".venv/bin/python", "-m", "poetry", "install", "--no-root"])
+_INTERPRETER_URL = "https://github.com/indygreg/python-build-standalone/releases/download/20210506/cpython-3.8.10-x86_64-unknown-linux-gnu-pgo-20210506T0943.tar.zst"
+_INTERPRETER_DIR = os.path.expanduser("~/.self-debug")
+_INTERPRETER_METADATA = os.path.join(_INTERPRETER_DIR, "python/PYTHON.json")
+_SETUP_LOCK = _INTERPRETER_DIR + ".lock"
+_VENV_DIR = os.path.join(PROJECT_ROOT, ".venv")
+_VENV_FINGERPRINT = os.path.join(_VENV_DIR, ".self-debug-fingerprint")
+
+_test_env_fingerprint = None
+_test_env_lock = threading.Lock()
+
+
+def _install_interpreter() -> None:
+    # Download the Python binary and extract it as it is decompressed
+    response = requests.get(_INTERPRETER_URL, stream=True)
+    response.raise_for_status()
+    response.raw.decode_content = True
+
+    # Extract next to the target, so that an interrupted install is never used
+    tmp_dir = tempfile.mkdtemp(
+        prefix=".self-debug-", dir=os.path.dirname(_INTERPRETER_DIR)
+    )
+    try:
+        with pyzstd.ZstdFile(response.raw, "rb") as archive:
+            with tarfile.open(fileobj=archive, mode="r|") as tar:
+                tar.extractall(tmp_dir)
+        if os.path.exists(_INTERPRETER_DIR):
+            shutil.rmtree(_INTERPRETER_DIR)
+        os.replace(tmp_dir, _INTERPRETER_DIR)
+    finally:
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+
+
+def _fingerprint() -> str:
+    contents = []
+    for path in [_INTERPRETER_METADATA, os.path.join(PROJECT_ROOT, "poetry.lock")]:
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                contents.append(f.read())
+    return xxh64(b"".join(contents)).hexdigest()
+
+
+def setup_test_env() -> str:
+    """
+    Set up the test interpreter in `.venv` and return its fingerprint.
+
+    The interpreter build and `poetry.lock` are fingerprinted, the setup is
+    skipped when `.venv` was already set up for the same fingerprint. It only
+    runs once per process, on the first call, and one process at a time.
+    """
+    global _test_env_fingerprint
+    with _test_env_lock:
+        if _test_env_fingerprint is not None:
+            return _test_env_fingerprint
+
+        if platform.system() != "Linux":
+            raise OSError("This script only supports Linux.")
+        with open(_SETUP_LOCK, "w") as lock:
+            # Workers of the same host wait for the one setting up
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            _test_env_fingerprint = _setup_test_env()
+        return _test_env_fingerprint
+
+
+def _setup_test_env() -> str:
+    if not os.path.exists(_INTERPRETER_METADATA):
+        _install_interpreter()
+
+    fingerprint = _fingerprint()
+    if os.path.exists(_VENV_FINGERPRINT):
+        with open(_VENV_FINGERPRINT) as f:
+            installed = f.read().strip()
+    else:
+        installed = None
+
+    if installed != fingerprint:
+        # Set the Python interpreter path
+        python_metadata = json.load(open(_INTERPRETER_METADATA))
+        python_interpreter = os.path.join(
+            os.path.dirname(_INTERPRETER_METADATA), python_metadata["python_exe"]
+        )
+
+        # Install venv
+        _subprocess_run([python_interpreter, "-m", "venv", _VENV_DIR])
+
+        # Install dependencies
+        pip = os.path.join(_VENV_DIR, "bin/pip")
+        python = os.path.join(_VENV_DIR, "bin/python")
+        _subprocess_run([pip, "install", "-U", "pip"])
+        _subprocess_run([pip, "install", "-U", "poetry"])
+        _subprocess_run(
+            [python, "-m", "poetry", "install", "--no-root"], cwd=PROJECT_ROOT
+        )
+
+        # Only mark the setup as done once every step succeeded
+        with open(_VENV_FINGERPRINT + ".tmp", "w") as f:
+            f.write(fingerprint)
+        os.replace(_VENV_FINGERPRINT + ".tmp", _VENV_FINGERPRINT)
+
+    return fingerprint
 
 
 def hashes(doc: str) -> str:
     return xxh64(doc).hexdigest()
+
+
+def test_env_fingerprint() -> str:
+    """
+    Fingerprint the test interpreter from its build metadata and the locked
+    dependencies installed in `.venv`, setting it up if needed.
+    """
+    return setup_test_env()
@@ -0,0 +1,356 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from tqdm.auto import tqdm
+
+from src.scheduler import Job, ProblemScheduler
+
+
+class Lease(NamedTuple):
+    job_id: int
+    job: Job
+
+
+class QueueBackend(ABC):
+    """
+    A queue of DS-1000 jobs leased by workers.
+
+    A leased job must be kept alive with `heartbeat`, otherwise its lease
+    expires and the job is leased again to another worker. Implementations
+    backed by a network broker only need to provide these methods.
+    """
+
+    @abstractmethod
+    def enqueue(self, jobs: List[Job]) -> int:
+        """
+        Add the jobs that are not queued yet, and make the failed ones pending
+        again. Return the number of jobs made pending.
+        """
+
+    @abstractmethod
+    def lease(self, worker_id: str, lease_seconds: float) -> Optional[Lease]:
+        """
+        Lease a pending job, or a job whose lease expired, to `worker_id`.
+        Return None when there is no such job.
+        """
+
+    @abstractmethod
+    def heartbeat(self, job_id: int, worker_id: str, lease_seconds: float) -> bool:
+        """
+        Extend the lease of a job, return False if the worker lost it.
+        """
+
+    @abstractmethod
+    def complete(
+        self,
+        job_id: int,
+        worker_id: str,
+        result: dict,
+        follow_up: Optional[Job] = None,
+    ) -> bool:
+        """
+        Store the result of a leased job and enqueue its follow-up job
+        atomically, return False if the worker lost the lease.
+        """
+
+    @abstractmethod
+    def fail(self, job_id: int, worker_id: str, error: str) -> None:
+        """
+        Mark a leased job as failed, it is pending again on the next enqueue.
+        """
+
+    @abstractmethod
+    def counts(self) -> Dict[str, int]:
+        """
+        The number of jobs per status.
+        """
+
+    @abstractmethod
+    def results(self) -> List[Tuple[Job, dict]]:
+        """
+        The completed jobs with their results, by attempt.
+        """
+
+
+def _encode(job: Job) -> tuple:
+    return job.lib, job.index, job.attempt, json.dumps(job.feedback)
+
+
+def _decode(lib: str, index: int, attempt: int, feedback: str) -> Job:
+    feedback = json.loads(feedback)
+    return Job(lib, index, attempt, tuple(feedback) if feedback else None)
+
+
+class SQLiteQueue(QueueBackend):
+    """
+    A queue in a single SQLite file, shared by the processes of a single host.
+
+    The file uses WAL journaling, which relies on shared memory between the
+    processes: it must not be shared over a network file system (NFS, SMB).
+    Workers on other hosts need a broker-backed `QueueBackend` instead.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, timeout=60, check_same_thread=False, isolation_level=None
+        )
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY, lib TEXT NOT NULL, idx INTEGER NOT NULL, "
+                "attempt INTEGER NOT NULL, feedback TEXT NOT NULL, "
+                "status TEXT NOT NULL, worker TEXT, lease_expires REAL, result TEXT, "
+                "UNIQUE (lib, idx, attempt))"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_expires)"
+            )
+
+    def _transaction(self, statements) -> object:
+        # BEGIN IMMEDIATE serializes the writers of every process
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                value = statements(self._conn)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return value
+
+    def enqueue(self, jobs: List[Job]) -> int:
+        def statements(conn) -> int:
+            pending = 0
+            for job in jobs:
+                pending += conn.execute(
+                    "INSERT OR IGNORE INTO jobs (lib, idx, attempt, feedback, status) "
+                    "VALUES (?, ?, ?, ?, 'pending')",
+                    _encode(job),
+                ).rowcount
+            # Problems that failed with an error are left to the next run
+            pending += conn.execute(
+                "UPDATE jobs SET status = 'pending', worker = NULL "
+                "WHERE status = 'failed'"
+            ).rowcount
+            return pending
+
+        return self._transaction(statements)
+
+    def lease(self, worker_id: str, lease_seconds: float) -> Optional[Lease]:
+        def statements(conn) -> Optional[Lease]:
+            now = time.time()
+            # Serve the most advanced problems first
+            row = conn.execute(
+                "SELECT id, lib, idx, attempt, feedback FROM jobs "
+                "WHERE status = 'pending' "
+                "OR (status = 'leased' AND lease_expires < ?) "
+                "ORDER BY attempt DESC, id LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'leased', worker = ?, lease_expires = ? "
+                "WHERE id = ?",
+                (worker_id, now + lease_seconds, row[0]),
+            )
+            return Lease(row[0], _decode(*row[1:]))
+
+        return self._transaction(statements)
+
+    def heartbeat(self, job_id: int, worker_id: str, lease_seconds: float) -> bool:
+        def statements(conn) -> bool:
+            return (
+                conn.execute(
+                    "UPDATE jobs SET lease_expires = ? "
+                    "WHERE id = ? AND worker = ? AND status = 'leased'",
+                    (time.time() + lease_seconds, job_id, worker_id),
+                ).rowcount
+                == 1
+            )
+
+        return self._transaction(statements)
+
+    def complete(
+        self,
+        job_id: int,
+        worker_id: str,
+        result: dict,
+        follow_up: Optional[Job] = None,
+    ) -> bool:
+        def statements(conn) -> bool:
+            completed = conn.execute(
+                "UPDATE jobs SET status = 'done', result = ? "
+                "WHERE id = ? AND worker = ? AND status = 'leased'",
+                (json.dumps(result), job_id, worker_id),
+            ).rowcount
+            if completed and follow_up is not None:
+                conn.execute(
+                    "INSERT OR IGNORE INTO jobs (lib, idx, attempt, feedback, status) "
+                    "VALUES (?, ?, ?, ?, 'pending')",
+                    _encode(follow_up),
+                )
+            return completed == 1
+
+        return self._transaction(statements)
+
+    def fail(self, job_id: int, worker_id: str, error: str) -> None:
+        self._transaction(
+            lambda conn: conn.execute(
+                "UPDATE jobs SET status = 'failed', result = ? "
+                "WHERE id = ? AND worker = ? AND status = 'leased'",
+                (json.dumps({"error": error}), job_id, worker_id),
+            )
+        )
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+            ).fetchall()
+        return dict(rows)
+
+    def results(self) -> List[Tuple[Job, dict]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT lib, idx, attempt, feedback, result FROM jobs "
+                "WHERE status = 'done' ORDER BY attempt, id"
+            ).fetchall()
+        return [(_decode(*row[:4]), json.loads(row[4])) for row in rows]
+
+
+def coordinate(scheduler: ProblemScheduler, queue: QueueBackend, libraries: List[str]):
+    """
+    Enqueue the initial jobs of every pending problem.
+    """
+    jobs = [
+        Job(lib=lib, index=i, attempt=0, feedback=None)
+        for lib, i in scheduler.pending(libraries)
+    ]
+    pending = queue.enqueue(jobs)
+    print(f"Enqueued {pending} jobs, queue: {queue.counts()}")
+
+
+class QueueWorker:
+    """
+    Leases jobs from a queue and solves them with a `ProblemScheduler`, one job
+    per thread. A failed test completes the job with a self-correction job.
+    """
+
+    def __init__(
+        self,
+        scheduler: ProblemScheduler,
+        queue: QueueBackend,
+        worker_id: Optional[str] = None,
+        concurrency: int = 8,
+        lease_seconds: float = 300,
+        poll_interval: float = 5,
+    ) -> None:
+        self.scheduler = scheduler
+        self.queue = queue
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.concurrency = concurrency
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+
+    def _heartbeat(self, lease: Lease, stop: threading.Event) -> None:
+        while not stop.wait(self.lease_seconds / 3):
+            if not self.queue.heartbeat(
+                lease.job_id, self.worker_id, self.lease_seconds
+            ):
+                tqdm.write(f"Lost the lease of {lease.job.lib}_{lease.job.index:03d}")
+                return
+
+    def process(self, job: Job) -> Tuple[dict, Optional[Job]]:
+        challenge = self.scheduler.problem_dataset[job.lib][job.index]
+        generated_code = self.scheduler.generate(job)
+        is_correct = challenge.test(generated_code)
+        if isinstance(is_correct, tuple) and job.attempt < self.scheduler.max_attempts:
+            # Handle self-correction
+            follow_up = job._replace(attempt=job.attempt + 1, feedback=is_correct)
+            return {"code": generated_code, "final": False}, follow_up
+
+        solved = isinstance(is_correct, bool) and (is_correct == True)
+        return {"code": generated_code, "final": True, "solved": solved}, None
+
+    def _work(self, progress: tqdm) -> None:
+        while True:
+            lease = self.queue.lease(self.worker_id, self.lease_seconds)
+            if lease is None:
+                counts = self.queue.counts()
+                if not counts.get("pending") and not counts.get("leased"):
+                    return
+                # Jobs leased by others may come back, or have follow-ups
+                time.sleep(self.poll_interval)
+                continue
+
+            stop = threading.Event()
+            heartbeat = threading.Thread(
+                target=self._heartbeat, args=(lease, stop), daemon=True
+            )
+            heartbeat.start()
+            job = lease.job
+            try:
+                result, follow_up = self.process(job)
+            except Exception as e:
+                # Surface errors of a problem without stopping the others
+                tqdm.write(f"Failed to solve {job.lib}_{job.index:03d}: {e}")
+                self.queue.fail(lease.job_id, self.worker_id, str(e))
+                continue
+            finally:
+                stop.set()
+                heartbeat.join()
+            if not self.queue.complete(lease.job_id, self.worker_id, result, follow_up):
+                # Another worker owns the job since the lease expired
+                tqdm.write(f"Discarded the result of {job.lib}_{job.index:03d}")
+                if result["final"]:
+                    self.scheduler.problem_dataset[job.lib][job.index].release_answers()
+                continue
+            if result["final"]:
+                self.scheduler.finish(job, result["solved"])
+            progress.update(1)
+
+    def run(self) -> None:
+        progress = tqdm(desc=f"Jobs done by {self.worker_id}")
+        threads = [
+            threading.Thread(target=self._work, args=(progress,), daemon=True)
+            for _ in range(self.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        progress.close()
+
+
+def merge(queue: QueueBackend, output_dir: str, strategy: str) -> None:
+    """
+    Write the generated code and the correctness markers of the jobs solved
+    by every worker into `output_dir`, as a single-process run would.
+    """
+    for stage in ["initial", "correcting"]:
+        os.makedirs(os.path.join(output_dir, stage, strategy), exist_ok=True)
+
+    def artifact(stage: str, job: Job, ext: str) -> str:
+        return os.path.join(
+            output_dir, stage, strategy, f"{job.lib}_{str(job.index).zfill(3)}.{ext}"
+        )
+
+    # results are ordered by attempt, so the last attempt wins
+    for job, result in queue.results():
+        stage = "initial" if job.attempt == 0 else "correcting"
+        with open(artifact(stage, job, "py"), "w") as f:
+            f.write(result["code"])
+        if result["final"]:
+            with open(artifact("correcting", job, "txt"), "w") as f:
+                f.write("Correct" if result["solved"] else "Incorrect")